@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+from pygame.locals import *
+
+import super_mario as sm
+
+ATLAS_WIDTH = 128
+#transparent gap around each sprite in the sheet
+ATLAS_PADDING = 1
+
+def get_png_names():
+    names = []
+    for attr in sorted(vars(sm.GameRc)):
+        if attr.endswith("_png"):
+            names.append(getattr(sm.GameRc, attr))
+    return names
+
+def pack(sizes, width):
+    #shelf packing, tallest sprites first, returns {name: (x, y)} and the
+    #sheet height
+    order = sorted(sizes, key=lambda name: (-sizes[name][1], name))
+    positions = {}
+    x, y = 0, 0
+    shelf_h = 0
+    for name in order:
+        w, h = sizes[name]
+        w += ATLAS_PADDING
+        h += ATLAS_PADDING
+        if w > width:
+            raise ValueError("%s is wider than the atlas" % name)
+        if x + w > width:
+            x = 0
+            y += shelf_h
+            shelf_h = 0
+        positions[name] = (x, y)
+        x += w
+        shelf_h = max(shelf_h, h)
+    return positions, y + shelf_h
+
+def build_atlas(sheet_path, manifest_path):
+    pygame.init()
+    imgs = {}
+    sizes = {}
+    for name in get_png_names():
+        imgs[name] = pygame.image.load(name)
+        sizes[name] = imgs[name].get_size()
+
+    positions, height = pack(sizes, ATLAS_WIDTH)
+    sheet = pygame.Surface((ATLAS_WIDTH, height), SRCALPHA, 32)
+    sheet.fill((0, 0, 0, 0))
+    rects = {}
+    for name, img in imgs.iteritems():
+        x, y = positions[name]
+        w, h = sizes[name]
+        #max against the cleared sheet copies RGBA as is, a plain blit
+        #would blend and keep the sheet's zero alpha
+        sheet.blit(img, (x, y), None, BLEND_RGBA_MAX)
+        rects[name] = [x, y, w, h]
+
+    pygame.image.save(sheet, sheet_path)
+    #one sprite per line keeps the manifest diffable
+    lines = []
+    for name in sorted(rects):
+        lines.append("  %s: %s" % (json.dumps(name), json.dumps(rects[name])))
+    with open(manifest_path, "w") as f:
+        f.write('{\n "sheet": %s,\n "sprites": {\n'
+                % json.dumps(os.path.basename(sheet_path)))
+        f.write(",\n".join(lines))
+        f.write("\n }\n}\n")
+    print "packed %d sprites into %s, %dx%d" % (len(rects), sheet_path,
+                                                ATLAS_WIDTH, height)
+
+if __name__ == "__main__":
+    manifest_path = sm.ATLAS_MANIFEST
+    if len(sys.argv) > 1:
+        manifest_path = sys.argv[1]
+    sheet_path = os.path.splitext(manifest_path)[0] + ".png"
+    build_atlas(sheet_path, manifest_path)
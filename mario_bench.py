@@ -0,0 +1,626 @@
+import os
+import sys
+import json
+import timeit
+import argparse
+import subprocess
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+import super_mario as sm
+
+class Vector2(object):
+    #the parts of gameobjects' Vector2 that entity positions used before
+    #they became int lists, kept here as the update_pos baseline
+    __slots__ = ("_v",)
+
+    def __init__(self, x=0., y=0.):
+        self._v = [float(x), float(y)]
+
+    def __iadd__(self, rhs):
+        ox, oy = rhs
+        v = self._v
+        v[0] += ox
+        v[1] += oy
+        return self
+
+    def __getitem__(self, index):
+        return self._v[index]
+
+    def __iter__(self):
+        return iter(self._v[:])
+
+def init_game():
+    pygame.init()
+    pygame.display.set_mode(sm.ORIGINAL_SIZE, 0, 32)
+    sm.game_rc = sm.GameRc()
+
+def make_entity(world, name, i):
+    x = (i * 16) % sm.ORIGINAL_SIZE[0]
+    pos = (x, sm.GROUND_Y)
+    if name == "ground":
+        return sm.Ground(world, (0, sm.ORIGINAL_SIZE[1]-1),
+                         sm.GROUND_BLOCK_ROWS, 16)
+    elif name == "wood":
+        return sm.Wood(world, pos, sm.game_rc.wood1_img)
+    elif name == "cloud":
+        return sm.Cloud(world, (x, 80), level=1)
+    elif name == "pipe":
+        return sm.Pipe(world, pos, level=8)
+    elif name == "rock":
+        return sm.Rock(world, (x, 100))
+    elif name == "brick":
+        return sm.Brick(world, (x, 64))
+    elif name == "plate":
+        return sm.Plate(world, (x, 64))
+    elif name == "goomba":
+        return sm.Goomba(world, pos)
+    elif name == "koopa":
+        return sm.Koopa(world, pos)
+    elif name == "mario":
+        return sm.Mario(world)
+
+ENTITY_NAMES = ("ground", "wood", "cloud", "pipe", "rock", "brick", "plate",
+                "goomba", "koopa", "mario")
+
+def collect_shared(world):
+    #images held by game_rc, including its caches, and the world itself
+    #are shared
+    shared = set([id(world), id(sm.game_rc)])
+    todo = list(vars(sm.game_rc).values())
+    while len(todo) > 0:
+        obj = todo.pop()
+        if id(obj) in shared:
+            continue
+        if isinstance(obj, dict):
+            todo.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            todo.extend(obj)
+        if isinstance(obj, (dict, list, tuple, pygame.Surface)):
+            shared.add(id(obj))
+    return shared
+
+def iter_refs(obj):
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            yield k
+            yield v
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            yield v
+    if hasattr(obj, "__dict__") and not isinstance(obj, type):
+        yield obj.__dict__
+    for cls in type(obj).__mro__:
+        for name in cls.__dict__.get("__slots__", ()):
+            if hasattr(obj, name):
+                yield getattr(obj, name)
+
+def deep_size(root, shared):
+    seen = set(shared)
+    size = 0
+    todo = [root]
+    while len(todo) > 0:
+        obj = todo.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, (type, type(sys))) or callable(obj):
+            continue
+        if obj is not root and isinstance(obj, sm.GameEntity):
+            continue
+        size += sys.getsizeof(obj)
+        if isinstance(obj, pygame.Surface):
+            w, h = obj.get_size()
+            size += w * h * obj.get_bytesize()
+            continue
+        todo.extend(iter_refs(obj))
+    return size
+
+def component_size(world, entity):
+    store = world.components
+    if store is None or entity.slot < 0:
+        return 0
+    size = 0
+    for name in store.COLUMNS:
+        column = getattr(store, name)
+        size += column.itemsize
+    return size
+
+def bench_memory(args):
+    init_game()
+    print "%-8s %8s %8s %8s" % ("entity", "object", "columns", "total")
+    for name in ENTITY_NAMES:
+        world = sm.World()
+        entities = []
+        for i in xrange(args.count):
+            entity = make_entity(world, name, i)
+            world.add_entity(entity)
+            entities.append(entity)
+        world.commit_changes()
+        shared = collect_shared(world)
+        obj_size = 0
+        col_size = 0
+        for entity in entities:
+            obj_size += deep_size(entity, shared)
+            col_size += component_size(world, entity)
+        obj_size /= len(entities)
+        col_size /= len(entities)
+        print "%-8s %8d %8d %8d" % (name, obj_size, col_size,
+                                    obj_size+col_size)
+
+def time_calls(func, count):
+    start = timeit.default_timer()
+    for i in xrange(count):
+        func()
+    return (timeit.default_timer() - start) * 1e9 / count
+
+def bench_update_pos(args):
+    init_game()
+    world = sm.World()
+    goomba = sm.Goomba(world, (100, sm.GROUND_Y))
+    world.add_entity(goomba)
+    world.commit_changes()
+
+    #back and forth so the entity stays inside the screen
+    offsets = [(1, 0), (-1, 0)]
+    def update_pos():
+        goomba.update_pos(offsets[0])
+        goomba.update_pos(offsets[1])
+    def move_by():
+        goomba.move_by(1, 0)
+        goomba.move_by(-1, 0)
+    def apply_offset():
+        goomba.apply_offset(1, 0)
+        goomba.apply_offset(-1, 0)
+    #apply_offset as it was with Vector2 positions, the rest of the call
+    #left as it is now
+    pos = Vector2(100, sm.GROUND_Y)
+    def vector2_apply():
+        for offset_x in (1, -1):
+            pos.__iadd__(Vector2(offset_x, 0))
+            goomba.rect.move_ip(offset_x, 0)
+            world.reindex_entity(goomba)
+    #the position arithmetic alone
+    rect = goomba.rect.copy()
+    def vector2_offset():
+        for offset_x in (1, -1):
+            pos.__iadd__(Vector2(offset_x, 0))
+            rect.move_ip(offset_x, 0)
+    def list_offset():
+        for offset_x in (1, -1):
+            goomba.pos[0] += offset_x
+            goomba.pos[1] += 0
+            rect.move_ip(offset_x, 0)
+    cases = [("update_pos", update_pos), ("move_by", move_by),
+             ("apply_offset", apply_offset), ("vector2 apply", vector2_apply),
+             ("list offset", list_offset),
+             ("vector2 offset", vector2_offset)]
+
+    print "%-16s %10s" % ("call", "ns/call")
+    times = {}
+    for name, func in cases:
+        times[name] = time_calls(func, args.count) / 2
+        print "%-16s %10.1f" % (name, times[name])
+    for new, old in (("apply_offset", "vector2 apply"),
+                     ("list offset", "vector2 offset")):
+        saved = times[old] - times[new]
+        print "%s saves %.1f ns/call over %s, %.1f%%" % (
+            new, saved, old, saved * 100 / times[old])
+
+def bench_upscale(args):
+    pygame.init()
+    sm.game_rc = None
+    print "%-8s %5s %10s %12s" % ("mode", "scale", "full ms", "region ms")
+    for mode in sm.Upscaler.MODES:
+        for scale in (2, 3, 4):
+            upscaler = sm.Upscaler(mode, scale)
+            if sm.game_rc is None:
+                sm.game_rc = sm.GameRc()
+            world = sm.construct_world()
+            world.render(upscaler.frame)
+
+            full = time_calls(upscaler.present, args.count) / 1e6
+            region = "-"
+            if upscaler.by_region:
+                #about one moving sprite worth of changes
+                rects = [pygame.Rect(100, 100, 32, 32)]
+                def present_region():
+                    upscaler.present(rects)
+                region = "%.3f" % (time_calls(present_region, args.count)
+                                   / 1e6)
+            print "%-8s %5d %10.3f %12s" % (mode, scale, full, region)
+
+def make_level(width):
+    #construct_world widened, with the same rocks, bricks and goombas
+    #every screen
+    world = sm.construct_world(width)
+    chunks = world.chunks
+    screen_w = sm.ORIGINAL_SIZE[0]
+    for left in xrange(screen_w, width, screen_w):
+        for i in xrange(6):
+            chunks.place(sm.Rock, (left + i*16, 120))
+            chunks.place(sm.Brick, (left + 32 + i*16, 64))
+        for i in xrange(3):
+            chunks.place(sm.Goomba, (left + 60 + i*40, sm.GROUND_Y))
+    world.commit_changes()
+    return world
+
+def move_camera(world, x):
+    world.camera.rect.x = x
+    world.chunks.update(world.camera.rect)
+    world.commit_changes()
+
+def bench_render(args):
+    init_game()
+    frame = pygame.Surface(sm.ORIGINAL_SIZE, 0, pygame.display.get_surface())
+    print "%-8s %9s %10s %12s" % ("width", "entities", "render ms",
+                                  "scrolled ms")
+    for width in args.widths:
+        world = make_level(width)
+        #camera in the middle of the level, then moving every frame so
+        #the static layer is rebuilt too
+        move_camera(world, max(0, (width - sm.ORIGINAL_SIZE[0])/2))
+        def render():
+            world.render(frame)
+        static = time_calls(render, args.count) / 1e6
+        def render_scrolled():
+            world.camera.rect.x ^= 1
+            world.render(frame)
+        scrolled = time_calls(render_scrolled, args.count) / 1e6
+        print "%-8d %9d %10.3f %12.3f" % (width, len(world.entity_list),
+                                          static, scrolled)
+
+def bench_stream(args):
+    init_game()
+    print "%-8s %8s %8s %6s %9s %9s %11s" % (
+        "width", "placed", "peak", "loads", "load ms", "max ms",
+        "unload ms")
+    for width in args.widths:
+        world = make_level(width)
+        placed = sum(len(specs) for specs in world.chunks.specs.itervalues())
+        #sweep the camera over the level and back
+        peak = 0
+        last_x = max(0, width - sm.ORIGINAL_SIZE[0])
+        for x in range(0, last_x, args.step) + \
+                 range(last_x, -1, -args.step):
+            move_camera(world, x)
+            peak = max(peak, len(world.entity_list))
+        stats = world.chunks.get_stats()
+        loads = max(1, stats["loads"])
+        unloads = max(1, stats["unloads"])
+        print "%-8d %8d %8d %6d %9.3f %9.3f %11.3f" % (
+            width, placed, peak, stats["loads"], stats["load_ms"]/loads,
+            stats["max_load_ms"], stats["unload_ms"]/unloads)
+
+def bench_headless(args):
+    upscaler = sm.init_headless(args.render)
+    script = None
+    if args.script is not None:
+        script = sm.load_key_script(args.script)
+    world = sm.construct_world(args.width)
+    if args.trace is not None:
+        sm.tracer = sm.Tracer(sm.TRACE_CAPACITY)
+    result = sm.run_headless(world, args.count, script, upscaler)
+    if args.trace is not None:
+        sm.tracer.dump(args.trace)
+    sm.report_headless(result)
+
+def make_course(width, rock_rows=0, streaming=True):
+    #open level for mario to run through: ground, bricks to jump under and
+    #clouds every screen, rock_rows full rows of rocks in the sky
+    world = sm.World(width=width)
+    chunks = sm.ChunkStreamer(world, sm.CHUNK_WIDTH, sm.CHUNK_LOAD_MARGIN,
+                              sm.CHUNK_UNLOAD_MARGIN)
+    world.chunks = chunks
+    chunks.update(world.camera.rect)
+    screen_w = sm.ORIGINAL_SIZE[0]
+    for left in xrange(0, width, screen_w):
+        chunks.place(sm.Ground, (left, sm.ORIGINAL_SIZE[1]-1),
+                     sm.GROUND_BLOCK_ROWS, 16)
+    world.mario = sm.Mario(world)
+    world.add_entity(world.mario)
+    for left in xrange(0, width, screen_w):
+        chunks.place(sm.Cloud, (left + 80, 64), level=1)
+        if rock_rows > 0:
+            continue
+        for i in xrange(3):
+            chunks.place(sm.Brick, (left + 128 + i*16, sm.GROUND_Y-60))
+    for row in xrange(rock_rows):
+        for x in xrange(0, width, 16):
+            chunks.place(sm.Rock, (x, 32 + row*16))
+    world.spawner.add_point(sm.SpawnPoint(sm.Koopa, sm.EntityName.KOOPA,
+                                          (144, 160),
+                                          sm.ENEMY_SPAWN_FRAMES, 1))
+    if not streaming:
+        make_resident(world)
+    world.commit_changes()
+    return world
+
+def make_run_script(frames, jump_every):
+    #hold right, and jump every jump_every frames when it is not 0
+    script = {5: [pygame.event.Event(sm.KEYDOWN, key=sm.K_RIGHT)]}
+    if jump_every > 0:
+        for frame in xrange(20, frames, jump_every):
+            script.setdefault(frame, []).append(
+                pygame.event.Event(sm.KEYDOWN, key=sm.K_f))
+            script.setdefault(frame + 15, []).append(
+                pygame.event.Event(sm.KEYUP, key=sm.K_f))
+    return script
+
+def make_resident(world):
+    #load every chunk and stop streaming, the whole level stays in the
+    #world whatever the camera does
+    chunks = world.chunks
+    for index in sorted(chunks.specs):
+        if index not in chunks.loaded:
+            chunks.load(index)
+    world.chunks = None
+
+def make_goombas(count, streaming=True):
+    #100 goombas per screen, the level widened to fit them; they are added
+    #outside the chunks so all of them stay in the world and awake
+    screens = max(1, count/100)
+    world = sm.construct_world(sm.ORIGINAL_SIZE[0] * screens)
+    for i in xrange(count):
+        x = (i / 100)*sm.ORIGINAL_SIZE[0] + 16 + (i*13) % 224
+        world.spawn_entity(sm.Goomba, (x, 40 + (i % 8)*20))
+    if not streaming:
+        make_resident(world)
+    world.commit_changes()
+    return world
+
+def make_shells(count):
+    #a row of koopas on the ground, all turned into moving shells
+    world = sm.construct_world()
+    koopas = []
+    for i in xrange(count):
+        koopas.append(world.spawn_entity(sm.Koopa, (24 + i*20, sm.GROUND_Y)))
+    world.commit_changes()
+    for koopa in koopas:
+        state_machine = koopa.state_machine
+        state_machine.switch_to(
+            state_machine.states[state_machine.body_state_name])
+    world.commit_changes()
+    return world
+
+def make_waves(screens, max_alive, wave, interval):
+    #a course with a goomba spawn point over every screen, waves of wave
+    #goombas every interval frames until max_alive are in the world
+    world = make_course(sm.ORIGINAL_SIZE[0] * screens)
+    for i in xrange(screens):
+        world.spawner.add_point(sm.SpawnPoint(
+            sm.Goomba, sm.EntityName.GOOMBA,
+            (i*sm.ORIGINAL_SIZE[0] + 32, 60), interval, max_alive, wave))
+    return world
+
+def build_scenario(name, frames):
+    #returns the world and key script for one of SCENARIOS
+    if name == "stock":
+        return sm.construct_world(), None
+    elif name == "goombas_100":
+        return make_goombas(100), None
+    elif name == "goombas_1000":
+        return make_goombas(1000), None
+    elif name == "goombas_1000_resident":
+        return make_goombas(1000, streaming=False), None
+    elif name == "shells":
+        return make_shells(10), None
+    elif name == "static_10k":
+        #1000 columns by 10 rows
+        return make_course(16000, rock_rows=10), make_run_script(frames, 0)
+    elif name == "static_10k_resident":
+        return make_course(16000, rock_rows=10, streaming=False), \
+               make_run_script(frames, 0)
+    elif name == "course":
+        return make_course(8192), make_run_script(frames, 45)
+    elif name == "waves":
+        #population ramps up to 300 goombas over 8 screens and stays
+        return make_waves(8, 300, 8, 30), make_run_script(frames, 45)
+    raise ValueError("unknown scenario %s" % name)
+
+#level entities are streamed in chunks around the camera, as in the game;
+#the _resident variants keep the whole level in the world to measure
+#scaling with entity count
+SCENARIOS = ("stock", "goombas_100", "goombas_1000", "goombas_1000_resident",
+             "shells", "static_10k", "static_10k_resident", "course", "waves")
+
+#World methods timed as the collision phase, calls made from inside one of
+#them count once
+COLLISION_METHODS = ("build_contact_table", "make_collision_entity_list",
+                     "make_moving_collision_list", "is_not_on_ground",
+                     "check_collision_x", "is_on_ground", "is_pushing_on",
+                     "fix_collision_x", "fix_collision_y", "exceed_border",
+                     "push_on_top_entity")
+#World.timers methods timed as the timers phase, spawns included
+TIMER_METHODS = ("advance",)
+
+class MethodTimer(object):
+    def __init__(self):
+        self.seconds = 0.0
+        self.depth = 0
+
+    def wrap(self, obj, names):
+        for name in names:
+            setattr(obj, name, self.make_timed(getattr(obj, name)))
+
+    def make_timed(self, method):
+        def timed(*args):
+            if self.depth > 0:
+                return method(*args)
+            self.depth += 1
+            start = timeit.default_timer()
+            try:
+                return method(*args)
+            finally:
+                self.seconds += timeit.default_timer() - start
+                self.depth -= 1
+        return timed
+
+def bench_scenario(args):
+    #one scenario in this process, prints its result as json
+    upscaler = sm.init_headless(not args.no_render)
+    world, script = build_scenario(args.name, args.count)
+    collision = MethodTimer()
+    collision.wrap(world, COLLISION_METHODS)
+    timers = MethodTimer()
+    timers.wrap(world.timers, TIMER_METHODS)
+    result = sm.run_headless(world, args.count, script, upscaler)
+    frames = max(args.count, 1)
+    result["phase_ms"]["collision"] = collision.seconds * 1000 / frames
+    result["phase_ms"]["timers"] = timers.seconds * 1000 / frames
+    print json.dumps(result, sort_keys=True)
+
+#phases in report order, update includes collision and timers
+SUITE_PHASES = ("update", "collision", "timers", "render", "scale",
+                "present")
+
+def bench_suite(args):
+    #every scenario in its own process, for a clean peak memory and module
+    #state
+    results = {"frames": args.count, "render": not args.no_render,
+               "scenarios": {}}
+    for name in args.scenarios or SCENARIOS:
+        cmd = [sys.executable, os.path.abspath(__file__), "scenario", name,
+               "-n", str(args.count)]
+        if args.no_render:
+            cmd.append("--no-render")
+        output = subprocess.check_output(cmd)
+        result = json.loads(output.strip().splitlines()[-1])
+        results["scenarios"][name] = result
+        print "%-21s %9.1f ticks/s  %s  spawned %d" % (
+            name, result["ticks_per_sec"],
+            " ".join("%s %.3f" % (phase, result["phase_ms"][phase]) \
+                     for phase in SUITE_PHASES),
+            result["spawned"])
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    print "results written to", args.output
+
+def find_regressions(baseline, results, threshold, min_delta_ms):
+    #(scenario, measure, baseline value, new value) for every phase that
+    #got slower, or tick rate that dropped, by more than threshold percent
+    regressions = []
+    limit = 1 + threshold/100.0
+    for name, result in sorted(results["scenarios"].iteritems()):
+        base = baseline["scenarios"].get(name)
+        if base is None:
+            continue
+        if result["ticks_per_sec"] * limit < base["ticks_per_sec"]:
+            regressions.append((name, "ticks_per_sec", base["ticks_per_sec"],
+                                result["ticks_per_sec"]))
+        for phase in SUITE_PHASES:
+            old = base["phase_ms"].get(phase)
+            new = result["phase_ms"].get(phase)
+            if old is None or new is None:
+                continue
+            if new > old * limit and new - old > min_delta_ms:
+                regressions.append((name, phase, old, new))
+    return regressions
+
+def bench_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+    if baseline["frames"] != results["frames"] or \
+       baseline["render"] != results["render"]:
+        print "warning: runs differ in frame count or rendering"
+
+    regressions = find_regressions(baseline, results, args.threshold,
+                                   args.min_delta)
+    for name, measure, old, new in regressions:
+        print "REGRESSION %-21s %-13s %10.3f -> %10.3f" % (name, measure,
+                                                           old, new)
+    if len(regressions) > 0:
+        sys.exit(1)
+    print "no regressions over %.0f%%" % args.threshold
+
+def main():
+    parser = argparse.ArgumentParser(description="Super Mario benchmarks")
+    subparsers = parser.add_subparsers()
+
+    memory = subparsers.add_parser("memory",
+                                   help="bytes per entity type")
+    memory.add_argument("-n", "--count", type=int, default=200)
+    memory.set_defaults(func=bench_memory)
+
+    update_pos = subparsers.add_parser("update_pos",
+                                       help="cost of moving an entity")
+    update_pos.add_argument("-n", "--count", type=int, default=100000)
+    update_pos.set_defaults(func=bench_update_pos)
+
+    upscale = subparsers.add_parser("upscale",
+                                    help="cost of each Upscaler mode")
+    upscale.add_argument("-n", "--count", type=int, default=200)
+    upscale.set_defaults(func=bench_upscale)
+
+    render = subparsers.add_parser("render",
+                                   help="render cost by level width")
+    render.add_argument("-n", "--count", type=int, default=200)
+    render.add_argument("widths", type=int, nargs="*",
+                        default=[256, 2560, 25600])
+    render.set_defaults(func=bench_render)
+
+    stream = subparsers.add_parser("stream",
+                                   help="chunk streaming by level width")
+    stream.add_argument("-s", "--step", type=int, default=4,
+                        help="camera pixels per frame")
+    stream.add_argument("widths", type=int, nargs="*",
+                        default=[256, 2560, 25600])
+    stream.set_defaults(func=bench_stream)
+
+    headless = subparsers.add_parser("headless",
+                                     help="simulation ticks per second")
+    headless.add_argument("-n", "--count", type=int, default=3000,
+                          help="frames to run")
+    headless.add_argument("-r", "--render", action="store_true",
+                          help="render and present every frame too")
+    headless.add_argument("-w", "--width", type=int, default=None,
+                          help="level width, one screen by default")
+    headless.add_argument("-s", "--script",
+                          help="json key script, see load_key_script")
+    headless.add_argument("-t", "--trace",
+                          help="write the last spans as a chrome trace")
+    headless.set_defaults(func=bench_headless)
+
+    suite = subparsers.add_parser("suite",
+                                  help="run the benchmark scenarios")
+    suite.add_argument("scenarios", nargs="*", metavar="scenario",
+                       help="some of %s, all by default"
+                       % ", ".join(SCENARIOS))
+    suite.add_argument("-n", "--count", type=int, default=600,
+                       help="frames per scenario")
+    suite.add_argument("--no-render", action="store_true",
+                       help="update only")
+    suite.add_argument("-o", "--output", default="bench_results.json")
+    suite.set_defaults(func=bench_suite)
+
+    scenario = subparsers.add_parser("scenario",
+                                     help="run one scenario, used by suite")
+    scenario.add_argument("name", choices=SCENARIOS)
+    scenario.add_argument("-n", "--count", type=int, default=600)
+    scenario.add_argument("--no-render", action="store_true")
+    scenario.set_defaults(func=bench_scenario)
+
+    compare = subparsers.add_parser("compare",
+                                    help="check suite results against a "
+                                    "baseline")
+    compare.add_argument("results", nargs="?", default="bench_results.json")
+    compare.add_argument("-b", "--baseline", default="bench_baseline.json",
+                         help="suite results to compare with, save a run "
+                         "there to make it the baseline")
+    compare.add_argument("-t", "--threshold", type=float, default=10,
+                         help="percent slower to count as a regression")
+    compare.add_argument("--min-delta", type=float, default=0.005,
+                         help="ms per frame below which changes are noise")
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
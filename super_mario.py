@@ -1,5 +1,15 @@
+import os
 import sys
+import json
+import time
 import logging
+import argparse
+import threading
+import cProfile
+import pstats
+import array
+import bisect
+import timeit
 try:
     import pygame_sdl2
     pygame_sdl2.import_as_pygame()
@@ -7,22 +17,205 @@ except:
     pass
 import pygame
 from pygame.locals import *
-from gameobjects.vector2 import Vector2
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import resource
+except ImportError:
+    resource = None
 
 class World(object):
-    def __init__(self):
+    def __init__(self, use_components=None, width=None):
         self.bg_color = SCREEN_BK_COLOR
+        #level size in pixels, the camera shows ORIGINAL_SIZE of it
+        if width is None:
+            width = ORIGINAL_SIZE[0]
+        self.width = width
+        self.height = ORIGINAL_SIZE[1]
+        self.camera = Camera(ORIGINAL_SIZE)
+        #level entities kept as specs and created around the camera, see
+        #construct_world
+        self.chunks = None
+        #frame timers, fired at the end of update()
+        self.timers = TimerWheel(TIMER_WHEEL_SLOTS)
+        #entity name -> count of entities added and not yet removed, for
+        #O(1) population checks, see Spawner
+        self.name_counts = {}
+        self.spawner = Spawner(self)
         self.next_eid = 1000
+        #eid lookup and the insertion ordered dense store, both only
+        #change in commit_changes()
         self.entities = {}
+        self.entity_list = []
+        self.active_list = []
+        self.contacts = {}
+        self.active_dirty = False
+        self.pending_adds = []
+        self.pending_removes = []
+        self.pending_wakes = []
+        self.etype_grids = {}
+        #entities in draw order, by etype in EntityType.ALL order then by
+        #eid, with the (layer, eid) sort keys kept alongside for bisect
+        self.etype_layers = {}
+        self.draw_list = []
+        self.draw_keys = []
+        for etype in EntityType.ALL:
+            self.etype_grids[etype] = SpatialGrid(GRID_CELL_SIZE)
+            self.etype_layers[etype] = len(self.etype_layers)
+        self.tile_map = TileMap(self.width, self.height)
+        if use_components is None:
+            use_components = USE_COMPONENTS
+        if use_components:
+            self.components = ComponentStore()
+        else:
+            self.components = None
+        self.pools = {}
+        #eid -> (img, etype, draw rect) as last drawn by render_dirty, and
+        #eids to look at on the next call besides the awake entities
+        self.drawn = {}
+        self.render_checks = []
+        self.full_redraw = True
+        self.drawn_view = None
+        #IS_STATIC entities in view composited once over bg_color, with the
+        #draw rect of each, rebuilt when one of them joins, leaves or moves,
+        #or when the camera moves
+        self.static_layer = None
+        self.static_rects = {}
+        self.static_dirty = True
+        self.static_strip = None
         self.mario = None
 
     def add_entity(self, entity):
+        #eid is given at once, the entity joins the world on next commit
         entity.eid = self.next_eid
-        self.entities[entity.eid] = entity
         self.next_eid += 1
+        self.pending_adds.append(entity)
+        self.name_counts[entity.name] = \
+            self.name_counts.get(entity.name, 0) + 1
 
     def remove_entity(self, entity):
-        del self.entities[entity.eid]
+        self.pending_removes.append(entity)
+
+    def get_count(self, name):
+        #entities of that name in the world, pending adds included
+        return self.name_counts.get(name, 0)
+
+    def get_pool(self, cls):
+        pool = self.pools.get(cls)
+        if pool is None:
+            pool = self.pools[cls] = EntityPool(cls, POOL_MAX_SIZE)
+        return pool
+
+    def spawn_entity(self, cls, pos):
+        #pooled classes reuse entities dropped by apply_pending_removes
+        if cls.POOLED:
+            entity = self.get_pool(cls).acquire(self, pos)
+        else:
+            entity = cls(self, pos)
+        self.add_entity(entity)
+        return entity
+
+    def wake_entity(self, entity):
+        self.pending_wakes.append(entity)
+        self.active_dirty = True
+
+    def sleep_entity(self, entity):
+        self.render_checks.append(entity.eid)
+        self.active_dirty = True
+
+    def commit_changes(self):
+        if len(self.pending_adds) > 0:
+            self.apply_pending_adds()
+        if len(self.pending_removes) > 0:
+            self.apply_pending_removes()
+        if self.active_dirty:
+            self.rebuild_active_list()
+
+    def apply_pending_adds(self):
+        for entity in self.pending_adds:
+            self.entities[entity.eid] = entity
+            self.entity_list.append(entity)
+            self.add_to_etype(entity)
+            if self.components is not None and not entity.IS_TILE:
+                self.components.attach(entity)
+                entity.attach_components(self.components)
+            if entity.awake:
+                self.pending_wakes.append(entity)
+                self.active_dirty = True
+        self.pending_adds = []
+
+    def apply_pending_removes(self):
+        removed = {}
+        for entity in self.pending_removes:
+            if self.entities.get(entity.eid) is not entity:
+                continue
+            removed[entity.eid] = entity
+            del self.entities[entity.eid]
+            self.name_counts[entity.name] -= 1
+            self.remove_from_etype(entity)
+            if entity.slot >= 0:
+                self.components.detach(entity)
+            if entity.POOLED:
+                self.get_pool(entity.__class__).release(entity)
+        self.pending_removes = []
+
+        if len(removed) == 0:
+            return
+        self.entity_list = [entity for entity in self.entity_list \
+                            if entity.eid not in removed]
+        self.active_dirty = True
+
+    def rebuild_active_list(self):
+        active = {}
+        for entity in self.active_list:
+            if entity.awake and entity.eid in self.entities:
+                active[entity.eid] = entity
+        for entity in self.pending_wakes:
+            if entity.awake and entity.eid in self.entities:
+                active[entity.eid] = entity
+        self.active_list = sorted(active.itervalues(), key=get_entity_eid)
+        self.pending_wakes = []
+        self.active_dirty = False
+
+    def add_to_etype(self, entity):
+        self.add_to_draw_list(entity)
+        self.render_checks.append(entity.eid)
+        if entity.IS_STATIC:
+            self.static_dirty = True
+        if entity.IS_TILE:
+            self.tile_map.insert(entity)
+        else:
+            self.etype_grids[entity.etype].insert(entity)
+
+    def remove_from_etype(self, entity):
+        self.remove_from_draw_list(entity)
+        self.render_checks.append(entity.eid)
+        if entity.IS_STATIC:
+            self.static_dirty = True
+        if entity.IS_TILE:
+            self.tile_map.remove(entity)
+        else:
+            self.etype_grids[entity.etype].remove(entity)
+
+    def retype_entity(self, entity, etype):
+        if entity.eid not in self.entities:
+            entity.etype = etype
+            return
+        self.remove_from_etype(entity)
+        entity.etype = etype
+        self.add_to_etype(entity)
+
+    def reindex_entity(self, entity):
+        if entity.IS_STATIC:
+            self.static_dirty = True
+        if entity.IS_TILE:
+            self.tile_map.update(entity)
+            return
+        self.etype_grids[entity.etype].update(entity)
+        if entity.slot >= 0:
+            self.components.sync_rect(entity)
 
     def get(self, entity_id):
         if entity_id in self.entities:
@@ -31,10 +224,48 @@ class World(object):
             return None
 
     def update(self):
-        for entity in self.entities.values():
-            if entity.eid != self.mario.eid:
+        self.commit_changes()
+        if self.components is not None:
+            self.components.run_systems(self.width)
+        self.build_contact_table()
+
+        #only awake entities need ticking, see GameEntity.wake/sleep.
+        #adds, removes and wakes are queued, so the list is stable here;
+        #entities put to sleep earlier this frame are skipped
+        mario = self.mario
+        if tracer is None:
+            for entity in self.active_list:
+                if entity is not mario and entity.awake:
+                    entity.update()
+            mario.update()
+        else:
+            self.update_entities_traced(tracer)
+
+        self.commit_changes()
+        self.camera.follow(mario, self.width)
+        if self.chunks is not None:
+            self.chunks.update(self.camera.rect)
+        #spawns and entity wake ups, a span of their own when tracing
+        if tracer is None:
+            self.timers.advance()
+        else:
+            start = tracer.clock()
+            self.timers.advance()
+            tracer.add("timers", "frame", start, tracer.clock())
+
+    def update_entities_traced(self, tracer):
+        #the update loop, with one span per entity named by its class
+        mario = self.mario
+        clock = tracer.clock
+        for entity in self.active_list:
+            if entity is not mario and entity.awake:
+                start = clock()
                 entity.update()
-        self.mario.update()
+                tracer.add(entity.__class__.__name__, "entity", start,
+                           clock())
+        start = clock()
+        mario.update()
+        tracer.add("Mario", "entity", start, clock())
 
     def process_key(self, event):
         #only supported on pygame_sdl2
@@ -45,19 +276,195 @@ class World(object):
             pass
         self.mario.process_key(event)
 
-    def render_with_etype(self, surface, etype):
-        for entity in self.entities.itervalues():
-            if entity.etype == etype:
-                entity.render(surface)
+    def add_to_draw_list(self, entity):
+        key = (self.etype_layers[entity.etype], entity.eid)
+        i = bisect.bisect_left(self.draw_keys, key)
+        self.draw_keys.insert(i, key)
+        self.draw_list.insert(i, entity)
+
+    def remove_from_draw_list(self, entity):
+        key = (self.etype_layers[entity.etype], entity.eid)
+        i = bisect.bisect_left(self.draw_keys, key)
+        del self.draw_keys[i]
+        del self.draw_list[i]
+
+    def get_visible_list(self):
+        #draw_list cut down to the entities around the camera view, in draw
+        #order already; chunk streaming keeps draw_list short however wide
+        #the level is
+        view = self.camera.rect
+        if self.width <= view.width:
+            return self.draw_list
+        collide = view.inflate(CULL_MARGIN*2, CULL_MARGIN*2).colliderect
+        return [entity for entity in self.draw_list if collide(entity.rect)]
+
+    def make_blits(self, visible, clip_rects):
+        #(img, dest) pairs in draw order, for one Surface.blits call; with
+        #the static layer, a static entity is only drawn again where a
+        #dynamic entity drawn before it would otherwise cover it. rects are
+        #in world coordinates, dest in screen coordinates
+        use_static_layer = USE_STATIC_LAYER
+        static_rects = self.static_rects
+        drawn = self.drawn
+        view_x, view_y = self.camera.rect.topleft
+        covered = []
+        blits = []
+        for entity in visible:
+            img = entity.img
+            pos = entity.pos
+            x = pos[0]
+            y = pos[1] - img.get_height() + 1
+            draw_rect = None
+            if use_static_layer:
+                if entity.eid in static_rects:
+                    if len(covered) == 0:
+                        continue
+                    draw_rect = static_rects[entity.eid]
+                    if draw_rect.collidelist(covered) == -1:
+                        continue
+                else:
+                    draw_rect = pygame.Rect((x, y), img.get_size())
+                    covered.append(draw_rect)
+            if clip_rects is not None:
+                if draw_rect is None:
+                    old = drawn.get(entity.eid)
+                    if old is None:
+                        draw_rect = entity.get_draw_rect()
+                    else:
+                        draw_rect = old[2]
+                if draw_rect.collidelist(clip_rects) == -1:
+                    continue
+            blits.append((img, (x - view_x, y - view_y)))
+        return blits
 
     def render(self, surface):
-        surface.fill(self.bg_color)
-        render_etypes = [EntityType.GROUND, EntityType.BACKGROUND,
-                         EntityType.STILL, EntityType.FOREGROUND,
-                         EntityType.BODY, EntityType.ENEMY,
-                         EntityType.MARIO]
-        for etype in render_etypes:
-            self.render_with_etype(surface, etype)
+        self.commit_changes()
+        visible = self.get_visible_list()
+        if USE_STATIC_LAYER:
+            layer = self.get_static_layer(surface)
+            strip = self.static_strip
+            surface.blit(layer, (0, 0),
+                         self.camera.rect.move(-strip.x, -strip.y))
+        else:
+            surface.fill(self.bg_color)
+        blit_all(surface, self.make_blits(visible, None))
+        #self.mario.debug(surface)
+
+    def get_static_layer(self, surface):
+        if self.static_dirty or \
+           not self.static_strip.contains(self.camera.rect):
+            self.build_static_layer(surface)
+        return self.static_layer
+
+    def build_static_layer(self, surface):
+        #over static_strip, the view widened by STATIC_LAYER_MARGIN on both
+        #sides within the level; static entities outside it are drawn with
+        #the dynamic ones
+        view = self.camera.rect
+        w = max(view.width,
+                min(self.width, view.width + STATIC_LAYER_MARGIN*2))
+        x = max(0, min(view.x - STATIC_LAYER_MARGIN, self.width - w))
+        strip = self.static_strip = pygame.Rect(x, view.y, w, view.height)
+        layer = self.static_layer
+        if layer is None or layer.get_size() != strip.size:
+            layer = pygame.Surface(strip.size, 0, surface)
+            self.static_layer = layer
+        layer.fill(self.bg_color)
+        if self.width <= view.width:
+            entities = self.draw_list
+        else:
+            collide = strip.inflate(CULL_MARGIN*2, CULL_MARGIN*2).colliderect
+            entities = [entity for entity in self.draw_list \
+                        if collide(entity.rect)]
+        view_x, view_y = strip.topleft
+        self.static_rects = {}
+        blits = []
+        for entity in entities:
+            if entity.IS_STATIC:
+                draw_rect = entity.get_draw_rect()
+                self.static_rects[entity.eid] = draw_rect
+                blits.append((entity.img, (draw_rect.x - view_x,
+                                           draw_rect.y - view_y)))
+        blit_all(layer, blits)
+        self.static_dirty = False
+
+    def invalidate(self):
+        self.full_redraw = True
+
+    def get_draw_state(self, entity):
+        return (entity.img, entity.etype, entity.get_draw_rect())
+
+    def collect_dirty_rects(self):
+        #old and new areas of every entity that moved, changed sprite or
+        #layer, joined or left the world since the last render_dirty
+        dirty = []
+        drawn = self.drawn
+        entities = self.entities
+        checks = self.render_checks
+        self.render_checks = []
+        for entity in self.active_list:
+            checks.append(entity.eid)
+        for eid in checks:
+            old = drawn.get(eid)
+            entity = entities.get(eid)
+            if entity is None:
+                if old is not None:
+                    dirty.append(old[2])
+                    del drawn[eid]
+                continue
+            new = self.get_draw_state(entity)
+            if old == new:
+                continue
+            if old is not None:
+                dirty.append(old[2])
+            dirty.append(new[2])
+            drawn[eid] = new
+        return dirty
+
+    def render_dirty(self, surface):
+        #like render, but only redraws the areas that changed since the
+        #last call; returns them, the whole surface on the first call and
+        #whenever the camera moved
+        self.commit_changes()
+        view = self.camera.rect
+        if self.full_redraw or self.drawn_view != view.topleft:
+            self.full_redraw = False
+            self.drawn_view = view.topleft
+            self.render(surface)
+            self.render_checks = []
+            #entities out of view are picked up by collect_dirty_rects once
+            #they move in, the camera staying put
+            self.drawn = {}
+            for entity in self.get_visible_list():
+                self.drawn[entity.eid] = self.get_draw_state(entity)
+            return [surface.get_rect()]
+
+        dirty_rects = []
+        for rect in merge_rects(self.collect_dirty_rects()):
+            rect = rect.clip(view)
+            if rect.width > 0 and rect.height > 0:
+                dirty_rects.append(rect)
+        if len(dirty_rects) == 0:
+            return dirty_rects
+
+        visible = self.get_visible_list()
+        screen_rects = [self.camera.to_screen(rect) for rect in dirty_rects]
+        if USE_STATIC_LAYER:
+            layer = self.get_static_layer(surface)
+            strip = self.static_strip
+            for rect in screen_rects:
+                surface.blit(layer, rect,
+                             rect.move(view.x - strip.x, view.y - strip.y))
+        else:
+            for rect in screen_rects:
+                surface.fill(self.bg_color, rect)
+        #merged rects never overlap, so nothing is drawn twice in one place
+        blits = self.make_blits(visible, dirty_rects)
+        for rect in screen_rects:
+            surface.set_clip(rect)
+            blit_all(surface, blits)
+        surface.set_clip(None)
+        return screen_rects
 
     def exceed_border(self, entity):
         w, h = entity.img.get_size()
@@ -69,23 +476,86 @@ class World(object):
         if ul_x <= left_border:
             entity.pos[0] = left_border
             return True
-        right_border = ORIGINAL_SIZE[0]-2
+        right_border = self.width-2
         if br_x >= right_border:
             entity.pos[0] = right_border - w + 1
             return True
         return False
 
+    def build_contact_table(self):
+        #one broad phase per frame: every awake entity gets the list of
+        #entities within CONTACT_MARGIN of it, in eid order
+        self.contacts = {}
+        #tiles are looked up in the tile map, only moving entities here
+        movers = [entity for entity in self.active_list \
+                  if not entity.IS_TILE]
+        if self.components is not None and numpy is not None:
+            contact_lists = self.components.find_contacts(movers,
+                                                          CONTACT_MARGIN)
+        else:
+            contact_lists = [self.find_contacts(entity, CONTACT_MARGIN) \
+                             for entity in movers]
+
+        for entity, contact_list in zip(movers, contact_lists):
+            contact_list.sort(key=get_entity_eid)
+            self.contacts[entity.eid] = (entity.rect.left, entity.rect.top,
+                                         contact_list)
+
+    def find_contacts(self, entity_in, margin):
+        rect = entity_in.rect.inflate(margin*2, margin*2)
+        contact_list = []
+        for grid in self.etype_grids.itervalues():
+            for entity in grid.query(rect):
+                if entity is not entity_in and \
+                   pygame.Rect.colliderect(rect, entity.rect):
+                    contact_list.append(entity)
+        return contact_list
+
+    def get_contacts(self, entity):
+        contact = self.contacts.get(entity.eid)
+        if contact is None:
+            return None
+        #moved too far since the table was built, the list may miss some
+        drift = CONTACT_MARGIN/2
+        left, top, contact_list = contact
+        if abs(entity.rect.left - left) > drift or \
+           abs(entity.rect.top - top) > drift:
+            return None
+        return contact_list
+
     def make_collision_entity_list(self, entity_in, target_etypes):
+        entity_list = self.make_moving_collision_list(entity_in,
+                                                      target_etypes)
+
+        rect = entity_in.rect
+        tile_list = [entity for entity in self.tile_map.query(rect) \
+                     if entity.etype in target_etypes and \
+                     entity is not entity_in and \
+                     pygame.Rect.colliderect(rect, entity.rect)]
+        if len(tile_list) > 0:
+            entity_list.extend(tile_list)
+            entity_list.sort(key=get_entity_eid)
+        return entity_list
+
+    def make_moving_collision_list(self, entity_in, target_etypes):
+        rect = entity_in.rect
+        contact_list = self.get_contacts(entity_in)
+        if contact_list is not None:
+            return [entity for entity in contact_list \
+                    if entity.etype in target_etypes and \
+                    pygame.Rect.colliderect(rect, entity.rect)]
+
         entity_list = []
 
-        for entity in self.entities.itervalues():
-            if entity.etype not in target_etypes:
-                continue
-            if entity_in.eid == entity.eid:
-                continue
-            if pygame.Rect.colliderect(entity_in.rect, entity.rect):
-                entity_list.append(entity)
+        for etype in target_etypes:
+            for entity in self.etype_grids[etype].query(rect):
+                if entity_in.eid == entity.eid:
+                    continue
+                if pygame.Rect.colliderect(rect, entity.rect):
+                    entity_list.append(entity)
 
+        #keep the result independent of grid cell layout
+        entity_list.sort(key=get_entity_eid)
         return entity_list
 
     def is_not_on_ground(self, entity):
@@ -128,14 +598,14 @@ class World(object):
             offset_x = entity1.rect.left - entity.rect.right
         else:
             offset_x = entity1.rect.right - entity.rect.left
-        entity.update_pos((offset_x, 0), with_direction=True)
+        entity.move_by(offset_x, 0)
 
     def fix_collision_y(self, entity, entity1, direction):
         if direction == GameDef.DIRECTION_UP:
             offset_y = entity1.rect.top - entity.rect.bottom
         else:
             offset_y = entity1.rect.bottom - entity.rect.top
-        entity.update_pos((0, offset_y), with_direction=True)
+        entity.move_by(0, offset_y)
 
     def calc_collision_align_x(self, entity, direction):
         collision_align = 0
@@ -160,8 +630,8 @@ class World(object):
     def is_out_of_screen(self, entity):
         #do not conisder out of top
         rect = entity.rect
-        if rect.right < 0 or rect.left > ORIGINAL_SIZE[0] or \
-           rect.bottom < 0 or rect.top > ORIGINAL_SIZE[1]:
+        if rect.right < 0 or rect.left > self.width or \
+           rect.bottom < 0 or rect.top > self.height:
             return True
         else:
             return False
@@ -181,31 +651,672 @@ class World(object):
         
         entity.rect.move_ip(*(0, 1))
 
+class Camera(object):
+    #the part of the world shown on screen, in world coordinates
+    def __init__(self, size):
+        self.rect = pygame.Rect((0, 0), size)
+
+    def follow(self, entity, world_width):
+        #keep the entity centered, without showing past the level ends
+        x = entity.rect.centerx - self.rect.width/2
+        self.rect.x = max(0, min(x, world_width - self.rect.width))
+
+    def to_screen(self, rect):
+        return rect.move(-self.rect.x, -self.rect.y)
+
+class ChunkStreamer(object):
+    #splits the level into chunk_width columns, the entities of a chunk are
+    #created when it comes within load_margin of the view and removed once
+    #it is unload_margin behind, so entity count follows the view size
+    def __init__(self, world, chunk_width, load_margin, unload_margin):
+        self.world = world
+        self.chunk_width = chunk_width
+        self.load_margin = load_margin
+        self.unload_margin = unload_margin
+        #chunk index -> [(cls, args, kwargs)], and for loaded chunks, chunk
+        #index -> [(eid, entity)] as created
+        self.specs = {}
+        self.loaded = {}
+        self.load_count = 0
+        self.unload_count = 0
+        self.load_time = 0.0
+        self.unload_time = 0.0
+        self.max_load_time = 0.0
+        self.max_unload_time = 0.0
+
+    def place(self, cls, pos, *args, **kwargs):
+        #cls(world, pos, *args, **kwargs) when its chunk is loaded
+        index = pos[0] // self.chunk_width
+        spec = (cls, (pos,) + args, kwargs)
+        self.specs.setdefault(index, []).append(spec)
+        if index in self.loaded:
+            self.loaded[index].append(self.make_entity(spec))
+
+    def make_entity(self, spec):
+        cls, args, kwargs = spec
+        world = self.world
+        if cls.POOLED and len(args) == 1 and len(kwargs) == 0:
+            entity = world.spawn_entity(cls, args[0])
+        else:
+            entity = cls(world, *args, **kwargs)
+            world.add_entity(entity)
+        return (entity.eid, entity)
+
+    def calc_range(self, view, margin):
+        chunk_width = self.chunk_width
+        return (max(0, (view.left - margin) // chunk_width),
+                (view.right - 1 + margin) // chunk_width)
+
+    def update(self, view):
+        first, last = self.calc_range(view, self.unload_margin)
+        for index in self.loaded.keys():
+            if index < first or index > last:
+                self.unload(index)
+        first, last = self.calc_range(view, self.load_margin)
+        for index in xrange(first, last+1):
+            if index not in self.loaded:
+                self.load(index)
+
+    def load(self, index):
+        start = timeit.default_timer()
+        self.loaded[index] = [self.make_entity(spec) \
+                              for spec in self.specs.get(index, ())]
+        elapsed = timeit.default_timer() - start
+        self.load_count += 1
+        self.load_time += elapsed
+        self.max_load_time = max(self.max_load_time, elapsed)
+        logging.debug("chunk %d loaded, %d entities in %.3f ms", index,
+                      len(self.loaded[index]), elapsed*1000)
+
+    def unload(self, index):
+        #entities already gone, or out of a pool under a new eid, are left
+        start = timeit.default_timer()
+        world = self.world
+        for eid, entity in self.loaded.pop(index):
+            if world.get(eid) is entity:
+                world.remove_entity(entity)
+        elapsed = timeit.default_timer() - start
+        self.unload_count += 1
+        self.unload_time += elapsed
+        self.max_unload_time = max(self.max_unload_time, elapsed)
+        logging.debug("chunk %d unloaded in %.3f ms", index, elapsed*1000)
+
+    def get_stats(self):
+        return {"chunks": len(self.specs),
+                "loaded": len(self.loaded),
+                "loads": self.load_count,
+                "unloads": self.unload_count,
+                "load_ms": self.load_time*1000,
+                "unload_ms": self.unload_time*1000,
+                "max_load_ms": self.max_load_time*1000,
+                "max_unload_ms": self.max_unload_time*1000}
+
+class Timer(object):
+    __slots__ = ("due", "callback", "args", "active")
+
+    def __init__(self, due, callback, args):
+        self.due = due
+        self.callback = callback
+        self.args = args
+        self.active = True
+
+    def cancel(self):
+        self.active = False
+
+class TimerWheel(object):
+    #frame timers with O(1) schedule, cancel and expiry. a timer due within
+    #slots frames waits in the near slot of its frame, a later one in the
+    #far slot of its block of slots frames, and moves down to the near
+    #wheel when its block comes up
+    def __init__(self, slots):
+        self.slots = slots
+        self.now = 0
+        self.near = [[] for i in xrange(slots)]
+        self.far = [[] for i in xrange(slots)]
+
+    def schedule(self, frames, callback, *args):
+        #callback(*args) at the end of the update frames frames from now,
+        #0 for the end of this one
+        timer = Timer(self.now + max(frames, 0), callback, args)
+        self.insert(timer)
+        return timer
+
+    def insert(self, timer):
+        slots = self.slots
+        if timer.due - self.now < slots:
+            self.near[timer.due % slots].append(timer)
+        else:
+            self.far[(timer.due // slots) % slots].append(timer)
+
+    def advance(self):
+        #fire this frame's timers in schedule order, then step to the next
+        slots = self.slots
+        now = self.now
+        if now % slots == 0:
+            #far slots also hold timers whole far wheel turns ahead, those
+            #go back in
+            block = self.far[(now // slots) % slots]
+            self.far[(now // slots) % slots] = []
+            for timer in block:
+                if timer.active:
+                    self.insert(timer)
+
+        #callbacks may add to the slot being fired
+        due = self.near[now % slots]
+        i = 0
+        while i < len(due):
+            timer = due[i]
+            i += 1
+            if timer.active:
+                timer.active = False
+                timer.callback(*timer.args)
+        del due[:]
+        self.now = now + 1
+
+class SpawnPoint(object):
+    __slots__ = ("cls", "name", "pos", "interval", "max_alive", "wave",
+                 "spacing", "delay", "left")
+
+    def __init__(self, cls, name, pos, interval, max_alive, wave=1,
+                 spacing=16, delay=None, total=None):
+        #every interval frames, from the end of the delay-th update on,
+        #up to wave cls entities named name spawn spacing apart from pos,
+        #as long as fewer than max_alive of that name are in the world and
+        #total, when given, is not used up
+        self.cls = cls
+        self.name = name
+        self.pos = pos
+        self.interval = interval
+        self.max_alive = max_alive
+        self.wave = wave
+        self.spacing = spacing
+        if delay is None:
+            delay = interval
+        self.delay = delay
+        self.left = total
+
+class Spawner(object):
+    #runs the spawn points of a level on World.timers, each check is a
+    #World.name_counts lookup however many entities there are
+    def __init__(self, world):
+        self.world = world
+        self.spawn_count = 0
+
+    def add_point(self, point):
+        world = self.world
+        if point.cls.POOLED:
+            world.get_pool(point.cls).reserve(world, point.wave)
+        world.timers.schedule(point.delay - 1, self.run_point, point)
+        return point
+
+    def run_point(self, point):
+        world = self.world
+        count = min(point.wave,
+                    point.max_alive - world.get_count(point.name))
+        if point.left is not None:
+            count = min(count, point.left)
+            point.left -= max(count, 0)
+        if point.left != 0:
+            world.timers.schedule(point.interval, self.run_point, point)
+
+        x, y = point.pos
+        for i in xrange(count):
+            world.spawn_entity(point.cls, (x + i*point.spacing, y))
+        if count > 0:
+            self.spawn_count += count
+            logging.debug("spawned %d %s at %s", count, point.name,
+                          point.pos)
+
+class SpatialGrid(object):
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.spans = {}
+
+    def calc_span(self, rect):
+        cell_size = self.cell_size
+        return (rect.left//cell_size, rect.top//cell_size,
+                rect.right//cell_size, rect.bottom//cell_size)
+
+    def add_to_cells(self, entity, span):
+        cells = self.cells
+        eid = entity.eid
+        for x in xrange(span[0], span[2]+1):
+            for y in xrange(span[1], span[3]+1):
+                cell = cells.get((x, y))
+                if cell is None:
+                    cell = cells[(x, y)] = {}
+                cell[eid] = entity
+
+    def remove_from_cells(self, entity, span):
+        cells = self.cells
+        eid = entity.eid
+        for x in xrange(span[0], span[2]+1):
+            for y in xrange(span[1], span[3]+1):
+                cell = cells[(x, y)]
+                del cell[eid]
+                if len(cell) == 0:
+                    del cells[(x, y)]
+
+    def insert(self, entity):
+        span = self.calc_span(entity.rect)
+        self.spans[entity.eid] = span
+        self.add_to_cells(entity, span)
+
+    def remove(self, entity):
+        span = self.spans.pop(entity.eid)
+        self.remove_from_cells(entity, span)
+
+    def update(self, entity):
+        span = self.spans.get(entity.eid)
+        if span is None:
+            return
+        new_span = self.calc_span(entity.rect)
+        if new_span == span:
+            return
+        self.remove_from_cells(entity, span)
+        self.add_to_cells(entity, new_span)
+        self.spans[entity.eid] = new_span
+
+    def query(self, rect):
+        span = self.calc_span(rect)
+        cells = self.cells
+        if span[0] == span[2] and span[1] == span[3]:
+            cell = cells.get((span[0], span[1]))
+            if cell is None:
+                return ()
+            return cell.values()
+
+        found = {}
+        x0, y0, x1, y1 = span
+        if (x1-x0+1) * (y1-y0+1) > len(cells):
+            #large areas, such as the camera view, over a sparse grid
+            for (x, y), cell in cells.iteritems():
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    found.update(cell)
+            return found.values()
+        for x in xrange(x0, x1+1):
+            for y in xrange(y0, y1+1):
+                cell = cells.get((x, y))
+                if cell is not None:
+                    found.update(cell)
+        return found.values()
+
+class TileMap(object):
+    #occupancy grid of TILE_SIZE cells for the solid blocks, stored column
+    #by column so that it can grow to the right
+    def __init__(self, width, height):
+        self.rows = height//TILE_SIZE + 1
+        self.columns = width//TILE_SIZE + 1
+        self.cells = [None] * (self.rows*self.columns)
+        self.spans = {}
+
+    def grow(self, columns):
+        self.cells.extend([None] * ((columns-self.columns)*self.rows))
+        self.columns = columns
+
+    def calc_span(self, rect):
+        #out of map rects are clamped onto the border cells
+        max_x = self.columns - 1
+        max_y = self.rows - 1
+        x0 = min(max(rect.left//TILE_SIZE, 0), max_x)
+        x1 = min(max(rect.right//TILE_SIZE, 0), max_x)
+        y0 = min(max(rect.top//TILE_SIZE, 0), max_y)
+        y1 = min(max(rect.bottom//TILE_SIZE, 0), max_y)
+        return (x0, y0, x1, y1)
+
+    def add_to_cells(self, entity, span):
+        cells = self.cells
+        rows = self.rows
+        for x in xrange(span[0], span[2]+1):
+            for y in xrange(span[1], span[3]+1):
+                idx = x*rows + y
+                if cells[idx] is None:
+                    cells[idx] = [entity]
+                else:
+                    cells[idx].append(entity)
+
+    def remove_from_cells(self, entity, span):
+        cells = self.cells
+        rows = self.rows
+        for x in xrange(span[0], span[2]+1):
+            for y in xrange(span[1], span[3]+1):
+                idx = x*rows + y
+                cells[idx].remove(entity)
+                if len(cells[idx]) == 0:
+                    cells[idx] = None
+
+    def insert(self, entity):
+        columns = entity.rect.right//TILE_SIZE + 1
+        if columns > self.columns:
+            self.grow(columns)
+        span = self.calc_span(entity.rect)
+        self.spans[entity.eid] = span
+        self.add_to_cells(entity, span)
+
+    def remove(self, entity):
+        span = self.spans.pop(entity.eid)
+        self.remove_from_cells(entity, span)
+
+    def update(self, entity):
+        span = self.spans.get(entity.eid)
+        if span is None:
+            return
+        new_span = self.calc_span(entity.rect)
+        if new_span == span:
+            return
+        self.remove_from_cells(entity, span)
+        self.add_to_cells(entity, new_span)
+        self.spans[entity.eid] = new_span
+
+    def query(self, rect):
+        x0, y0, x1, y1 = self.calc_span(rect)
+        cells = self.cells
+        rows = self.rows
+        if x0 == x1 and y0 == y1:
+            cell = cells[x0*rows + y0]
+            if cell is None:
+                return ()
+            return cell
+
+        found = {}
+        for x in xrange(x0, x1+1):
+            for y in xrange(y0, y1+1):
+                cell = cells[x*rows + y]
+                if cell is not None:
+                    for entity in cell:
+                        found[entity.eid] = entity
+        return found.values()
+
+class ComponentStore(object):
+    #int column mirror of the rect, heading, speed and walk counters of
+    #moving entities, for the batched walk pass. the entities still own
+    #that state, World.reindex_entity and the GameEntity setters copy every
+    #change into the columns
+    COLUMNS = ("in_use", "rect_left", "rect_top", "rect_right", "rect_bottom",
+               "heading_x", "speed_y", "walking", "move_counter",
+               "move_rate", "move_offset", "fall_cycle", "fall_frame",
+               "offset_x", "offset_y")
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.size = 0
+        self.free_slots = []
+        self.slot_entities = [None] * capacity
+        for name in self.COLUMNS:
+            setattr(self, name, make_int_column(capacity))
+
+        self.fall_frames = [data[0] for data in ENEMY_FALL_DATA]
+        self.fall_offsets = [data[1] for data in ENEMY_FALL_DATA]
+        if numpy is not None:
+            self.fall_frames = numpy.array(self.fall_frames, numpy.int32)
+            self.fall_offsets = numpy.array(self.fall_offsets, numpy.int32)
+
+    def grow(self):
+        capacity = self.capacity*2
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            setattr(self, name, grow_int_column(column, capacity))
+        self.slot_entities.extend([None] * (capacity - self.capacity))
+        self.capacity = capacity
+
+    def alloc_slot(self):
+        if len(self.free_slots) > 0:
+            return self.free_slots.pop()
+        if self.size == self.capacity:
+            self.grow()
+        self.size += 1
+        return self.size - 1
+
+    def attach(self, entity):
+        slot = self.alloc_slot()
+        for name in self.COLUMNS:
+            getattr(self, name)[slot] = 0
+        self.in_use[slot] = 1
+        self.slot_entities[slot] = entity
+        entity.slot = slot
+        self.heading_x[slot] = int(entity.heading[0])
+        self.speed_y[slot] = int(entity.speed_y)
+        self.sync_rect(entity)
+
+    def detach(self, entity):
+        slot = entity.slot
+        self.in_use[slot] = 0
+        self.walking[slot] = 0
+        self.slot_entities[slot] = None
+        self.free_slots.append(slot)
+        entity.slot = -1
+
+    def sync_rect(self, entity):
+        slot = entity.slot
+        rect = entity.rect
+        self.rect_left[slot] = rect.left
+        self.rect_top[slot] = rect.top
+        self.rect_right[slot] = rect.right
+        self.rect_bottom[slot] = rect.bottom
+
+    def init_walker(self, slot, move_offset, move_rate):
+        self.move_offset[slot] = move_offset
+        self.move_rate[slot] = move_rate
+        self.move_counter[slot] = 0
+        self.fall_cycle[slot] = 0
+        self.fall_frame[slot] = 0
+
+    def get_walk_offset(self, slot):
+        return (int(self.offset_x[slot]), int(self.offset_y[slot]))
+
+    def find_contacts(self, entities, margin, chunk_size=256):
+        #vectorized AABB test of the inflated rects of entities against
+        #every rect in the store, chunk_size rows at a time
+        size = self.size
+        in_use = self.in_use[:size] != 0
+        left = self.rect_left[:size]
+        top = self.rect_top[:size]
+        right = self.rect_right[:size]
+        bottom = self.rect_bottom[:size]
+        slot_entities = self.slot_entities
+
+        contact_lists = []
+        for start in xrange(0, len(entities), chunk_size):
+            chunk = entities[start:start+chunk_size]
+            slots = numpy.array([entity.slot for entity in chunk], numpy.int32)
+            overlap = (left[slots, None] - margin < right) & \
+                      (left < right[slots, None] + margin) & \
+                      (top[slots, None] - margin < bottom) & \
+                      (top < bottom[slots, None] + margin) & in_use
+            overlap[numpy.arange(len(chunk)), slots] = False
+            for row in overlap:
+                contact_lists.append([slot_entities[slot] \
+                                      for slot in numpy.flatnonzero(row)])
+        return contact_lists
+
+    def run_systems(self, width):
+        if self.size == 0:
+            return
+        if numpy is not None:
+            self.run_walk_system_vectorized(width)
+        else:
+            self.run_walk_system(width)
+
+    def run_walk_system(self, width):
+        #same steps as Goomba/Koopa normal states: move every move_rate
+        #frames, fall by ENEMY_FALL_DATA, then keep inside the world
+        right_border = width - 1
+        walking = self.walking
+        for slot in xrange(self.size):
+            if walking[slot] == 0:
+                continue
+
+            move_counter = (self.move_counter[slot]+1) % self.move_rate[slot]
+            self.move_counter[slot] = move_counter
+            offset_x = 0
+            if move_counter == 0:
+                offset_x = self.move_offset[slot] * self.heading_x[slot]
+
+            offset_y = 0
+            if self.speed_y[slot] != 0:
+                fall_cycle = self.fall_cycle[slot]
+                fall_frames = self.fall_frames[fall_cycle]
+                offset_y = self.fall_offsets[fall_cycle]
+                fall_frame = self.fall_frame[slot] + 1
+                if fall_frame >= fall_frames:
+                    fall_frame = 0
+                    if fall_frames > 0:
+                        self.fall_cycle[slot] = fall_cycle + 1
+                self.fall_frame[slot] = fall_frame
+
+            left = self.rect_left[slot]
+            right = self.rect_right[slot]
+            if left + offset_x < 0:
+                offset_x = -left
+            if right + offset_x >= right_border:
+                offset_x = right_border - right
+
+            self.offset_x[slot] = offset_x
+            self.offset_y[slot] = offset_y
+
+    def run_walk_system_vectorized(self, width):
+        slots = numpy.flatnonzero(self.walking[:self.size])
+        if len(slots) == 0:
+            return
+
+        move_counter = (self.move_counter[slots]+1) % self.move_rate[slots]
+        self.move_counter[slots] = move_counter
+        offset_x = numpy.where(move_counter == 0,
+                               self.move_offset[slots]*self.heading_x[slots],
+                               0)
+
+        falling = self.speed_y[slots] != 0
+        fall_cycle = self.fall_cycle[slots]
+        fall_frames = self.fall_frames[fall_cycle]
+        offset_y = numpy.where(falling, self.fall_offsets[fall_cycle], 0)
+        fall_frame = self.fall_frame[slots] + falling
+        fall_done = falling & (fall_frame >= fall_frames)
+        self.fall_frame[slots] = numpy.where(fall_done, 0, fall_frame)
+        self.fall_cycle[slots] = fall_cycle + (fall_done & (fall_frames > 0))
+
+        right_border = width - 1
+        left = self.rect_left[slots]
+        right = self.rect_right[slots]
+        offset_x = numpy.where(left + offset_x < 0, -left, offset_x)
+        offset_x = numpy.where(right + offset_x >= right_border,
+                               right_border - right, offset_x)
+
+        self.offset_x[slots] = offset_x
+        self.offset_y[slots] = offset_y
+
+class EntityPool(object):
+    def __init__(self, cls, max_size):
+        self.cls = cls
+        self.max_size = max_size
+        self.free = []
+
+    def acquire(self, world, pos):
+        if len(self.free) > 0:
+            entity = self.free.pop()
+            entity.reset(pos)
+            return entity
+        return self.cls(world, pos)
+
+    def release(self, entity):
+        if len(self.free) < self.max_size:
+            self.free.append(entity)
+
+    def reserve(self, world, count):
+        #build entities ahead of a spawn wave
+        while len(self.free) < min(count, self.max_size):
+            self.free.append(self.cls(world, (0, 0)))
+
 class GameEntity(object):
+    __slots__ = ("world", "name", "etype", "img", "pos", "heading", "rect",
+                 "eid", "slot", "walking", "awake")
+
+    START_AWAKE = False
+    #grid aligned solid block, kept in World.tile_map
+    IS_TILE = False
+    #removed entities go back to World.pools, see World.spawn_entity
+    POOLED = False
+    #sprite never changes, drawn from World.static_layer
+    IS_STATIC = False
+    #overridden per instance by entities that move on y
+    speed_y = 0
+
     def __init__(self, world, pos, name, etype, img):
-        w, h = img.get_size()
         self.world = world
         self.name = name
         self.etype = etype
         self.img = img
-        self.pos = Vector2(pos)
-        self.heading = Vector2(1, 0)
-        self.rect = build_rect_from_pos(pos, w, h)
+        #integer [x, y] lists, updated in place and kept in step with rect
+        self.pos = [pos[0], pos[1]]
+        self.heading = [1, 0]
+        self.rect = build_rect_from_hitbox(pos, game_rc.get_hitbox(img))
         self.eid = 0
+        self.slot = -1
+        self.walking = False
+        self.awake = self.START_AWAKE
+
+    def reset(self, pos, etype, img):
+        #back to the state __init__ leaves, for entities out of a pool
+        offset_x, w, h = game_rc.get_hitbox(img)
+        self.etype = etype
+        self.img = img
+        self.pos[0] = pos[0]
+        self.pos[1] = pos[1]
+        self.heading[0] = 1
+        self.heading[1] = 0
+        self.rect.size = (w, h)
+        self.rect.topleft = (pos[0] + offset_x, pos[1] - h)
+        self.eid = 0
+        self.slot = -1
+        self.walking = False
+        self.awake = self.START_AWAKE
 
     def set_img(self, img):
+        #the rect is kept, and only moved or resized when the new sprite's
+        #hitbox puts it somewhere else
         self.img = img
-        #del self.rect
-        w, h = self.img.get_size()
-        self.rect = build_rect_from_pos(self.pos, w, h)
+        offset_x, w, h = game_rc.get_hitbox(img)
+        pos = self.pos
+        left = pos[0] + offset_x
+        top = pos[1] - h
+        rect = self.rect
+        if rect.left == left and rect.top == top and \
+           rect.width == w and rect.height == h:
+            return
+        rect.size = (w, h)
+        rect.topleft = (left, top)
+        self.world.reindex_entity(self)
 
-    def render(self, surface):
-        h = self.img.get_height()
-        pos = (self.pos[0], self.pos[1]-h+1)
-        surface.blit(self.img, pos)
+    def get_draw_rect(self):
+        #area the sprite covers, not the same as the hitbox in rect
+        w, h = self.img.get_size()
+        return pygame.Rect(self.pos[0], self.pos[1]-h+1, w, h)
 
     def update(self):
         pass
+
+    def wake(self):
+        if self.awake:
+            return
+        self.awake = True
+        self.world.wake_entity(self)
+
+    def sleep(self):
+        if not self.awake:
+            return
+        self.awake = False
+        self.world.sleep_entity(self)
+
+    def sleep_for(self, frames):
+        #skip the updates of the next frames-1 frames, returns the wake up
+        #timer to cancel
+        self.sleep()
+        return self.world.timers.schedule(frames - 1, self.wake)
+
+    def set_etype(self, etype):
+        if self.etype == etype:
+            return
+        self.world.retype_entity(self, etype)
     
     def get_pos(self):
         return self.pos
@@ -214,29 +1325,53 @@ class GameEntity(object):
         pass
 
     def exceed_border_fix(self, offset_x):
-        right_border = ORIGINAL_SIZE[0] - 1
+        right_border = self.world.width - 1
         if (self.rect.left + offset_x) < 0:
             offset_x = -self.rect.left
         if (self.rect.right + offset_x) >= right_border:
             offset_x = right_border - self.rect.right
         return offset_x
 
-    def calc_offset(self, offset, heading):
-        offset_x, offset_y = offset[0]*heading[0], offset[1]*heading[1]
-        offset_x = self.exceed_border_fix(offset_x)
-        return (offset_x, offset_y)
-
     def update_pos(self, offset, with_direction=False):
+        if with_direction:
+            self.move_by(offset[0], offset[1])
+            return
+
         self.update_heading()
-        if with_direction == False:
-            heading = self.heading
-        else:
-            heading = (1, 1)
-        
-        offset = self.calc_offset(offset, heading)
-        offset_vector = Vector2(offset[0], offset[1])
-        self.pos += offset_vector
-        self.rect.move_ip(*(offset[0], offset[1]))
+        heading = self.heading
+        offset_x = self.exceed_border_fix(offset[0]*heading[0])
+        self.apply_offset(offset_x, offset[1]*heading[1])
+
+    def move_by(self, offset_x, offset_y):
+        #update_pos with_direction=True, without the offset tuple
+        self.update_heading()
+        offset_x = self.exceed_border_fix(offset_x)
+        self.apply_offset(offset_x, offset_y)
+
+    def apply_offset(self, offset_x, offset_y):
+        pos = self.pos
+        pos[0] += offset_x
+        pos[1] += offset_y
+        self.rect.move_ip(offset_x, offset_y)
+        self.world.reindex_entity(self)
+
+    def attach_components(self, components):
+        pass
+
+    def set_heading_x(self, heading_x):
+        self.heading[0] = heading_x
+        if self.slot >= 0:
+            self.world.components.heading_x[self.slot] = int(heading_x)
+
+    def set_speed_y(self, speed_y):
+        self.speed_y = speed_y
+        if self.slot >= 0:
+            self.world.components.speed_y[self.slot] = int(speed_y)
+
+    def set_walking(self, walking):
+        self.walking = walking
+        if self.slot >= 0:
+            self.world.components.walking[self.slot] = int(walking)
 
     def handle_push(self):
         pass
@@ -271,6 +1406,9 @@ class EntityType(object):
     ENEMY = "enemy"
     BODY = "body"
 
+    #also the render order, from bottom to top
+    ALL = (GROUND, BACKGROUND, STILL, FOREGROUND, BODY, ENEMY, MARIO)
+
 class GameRc(object):
     rock_png = "rock_16x16.png"
     brick_png = "brick_16x16.png"
@@ -301,33 +1439,96 @@ class GameRc(object):
     koopa4_png = "koopa4_16x14.png"
 
     def __init__(self):
-        self.rock_img = get_img(self.rock_png)
-        self.brick_img = get_img(self.brick_png)
-        self.ground_block_img = get_img(self.ground_block_png)
-        self.wood1_img = get_img(self.wood1_png)
-        self.wood2_img = get_img(self.wood2_png)
-        self.plate1_img = get_img(self.plate1_png)
-        self.plate2_img = get_img(self.plate2_png)
-        self.plate3_img = get_img(self.plate3_png)
-        self.plate4_img = get_img(self.plate4_png)
-        self.cloud1_img = get_img(self.cloud1_png)
-        self.cloud2_img = get_img(self.cloud2_png)
-        self.cloud3_img = get_img(self.cloud3_png)
-        self.pipe1_img = get_img(self.pipe1_png)
-        self.pipe2_img = get_img(self.pipe2_png)
-        self.pipe3_img = get_img(self.pipe3_png)
-        self.mario1_img = get_img(self.mario1_png)
-        self.mario2_img = get_img(self.mario2_png)
-        self.mario3_img = get_img(self.mario3_png)
-        self.mario4_img = get_img(self.mario4_png)
-        self.mario5_img = get_img(self.mario5_png)
-        self.mario6_img = get_img(self.mario6_png)
-        self.goomba1_img = get_img(self.goomba1_png)
-        self.goomba2_img = get_img(self.goomba2_png)
-        self.koopa1_img = get_img(self.koopa1_png)
-        self.koopa2_img = get_img(self.koopa2_png)
-        self.koopa3_img = get_img(self.koopa3_png)
-        self.koopa4_img = get_img(self.koopa4_png)
+        #all *_png sprites come from one sheet when build_atlas.py has
+        #packed them, single files are the fallback
+        self.atlas_sheet = None
+        self.atlas_rects = {}
+        self.load_atlas(ATLAS_MANIFEST)
+
+        self.rock_img = self.get_sprite(self.rock_png)
+        self.brick_img = self.get_sprite(self.brick_png)
+        self.ground_block_img = self.get_sprite(self.ground_block_png)
+        self.wood1_img = self.get_sprite(self.wood1_png)
+        self.wood2_img = self.get_sprite(self.wood2_png)
+        self.plate1_img = self.get_sprite(self.plate1_png)
+        self.plate2_img = self.get_sprite(self.plate2_png)
+        self.plate3_img = self.get_sprite(self.plate3_png)
+        self.plate4_img = self.get_sprite(self.plate4_png)
+        self.cloud1_img = self.get_sprite(self.cloud1_png)
+        self.cloud2_img = self.get_sprite(self.cloud2_png)
+        self.cloud3_img = self.get_sprite(self.cloud3_png)
+        self.pipe1_img = self.get_sprite(self.pipe1_png)
+        self.pipe2_img = self.get_sprite(self.pipe2_png)
+        self.pipe3_img = self.get_sprite(self.pipe3_png)
+        self.mario1_img = self.get_sprite(self.mario1_png)
+        self.mario2_img = self.get_sprite(self.mario2_png)
+        self.mario3_img = self.get_sprite(self.mario3_png)
+        self.mario4_img = self.get_sprite(self.mario4_png)
+        self.mario5_img = self.get_sprite(self.mario5_png)
+        self.mario6_img = self.get_sprite(self.mario6_png)
+        self.goomba1_img = self.get_sprite(self.goomba1_png)
+        self.goomba2_img = self.get_sprite(self.goomba2_png)
+        self.koopa1_img = self.get_sprite(self.koopa1_png)
+        self.koopa2_img = self.get_sprite(self.koopa2_png)
+        self.koopa3_img = self.get_sprite(self.koopa3_png)
+        self.koopa4_img = self.get_sprite(self.koopa4_png)
+
+        self.hitboxes = {}
+        for name, img in vars(self).items():
+            if name.endswith("_img"):
+                self.add_hitbox(img)
+        self.transformed = {}
+        #level -> composite pipe surface, shared by all pipes of a level
+        self.pipe_imgs = {}
+
+    def load_atlas(self, manifest_path):
+        if not os.path.exists(manifest_path):
+            return
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        sheet_path = os.path.join(os.path.dirname(manifest_path),
+                                  manifest["sheet"])
+        self.atlas_sheet = get_img(sheet_path)
+        self.atlas_rects = manifest["sprites"]
+
+    def get_sprite(self, png):
+        rect = self.atlas_rects.get(png)
+        if rect is None:
+            return get_img(png)
+        return self.atlas_sheet.subsurface(rect)
+
+    def get_transformed(self, img, flip_x=False, flip_y=False, rotation=0):
+        #one shared surface per (img, flip_x, flip_y, rotation), every
+        #flip or rotation of a sprite should come from here
+        key = (img, flip_x, flip_y, rotation)
+        transformed = self.transformed.get(key)
+        if transformed is None:
+            transformed = img
+            if flip_x or flip_y:
+                transformed = pygame.transform.flip(transformed,
+                                                    flip_x, flip_y)
+            if rotation != 0:
+                transformed = pygame.transform.rotate(transformed, rotation)
+            self.transformed[key] = transformed
+            self.add_hitbox(transformed)
+        return transformed
+
+    def add_hitbox(self, img, offset_x=0, w=None):
+        #(offset_x, w, h) of the rect under a sprite, see GameEntity.set_img
+        img_w, img_h = img.get_size()
+        if w is None:
+            w = img_w
+        hitbox = (offset_x, w-1, img_h-1)
+        self.hitboxes[img] = hitbox
+        return hitbox
+
+    def get_hitbox(self, img):
+        hitbox = self.hitboxes.get(img)
+        if hitbox is None:
+            #surfaces built outside GameRc are not kept
+            w, h = img.get_size()
+            hitbox = (0, w-1, h-1)
+        return hitbox
 
 class GameDef(object):
     DIRECTION_LEFT = -1
@@ -337,6 +1538,11 @@ class GameDef(object):
     DIRECTION_NONE = 0
 
 class Ground(GameEntity):
+    __slots__ = ("rows", "columns")
+
+    IS_TILE = True
+    IS_STATIC = True
+
     def make_img(self, rows, columns):
         block_img = game_rc.ground_block_img
         block_w, block_h = block_img.get_size()
@@ -356,11 +1562,19 @@ class Ground(GameEntity):
                             EntityType.GROUND, img)
 
 class Wood(GameEntity):
+    __slots__ = ()
+
+    IS_STATIC = True
+
     def __init__(self, world, pos, img):
         GameEntity.__init__(self, world, pos, EntityName.WOOD,
                             EntityType.BACKGROUND, img)
 
 class Cloud(GameEntity):
+    __slots__ = ()
+
+    IS_STATIC = True
+
     def make_img(self, level):
         w1,h = game_rc.cloud1_img.get_size()
         w2 = game_rc.cloud2_img.get_width()
@@ -385,6 +1599,10 @@ class Cloud(GameEntity):
                             EntityType.BACKGROUND, img)
 
 class Pipe(GameEntity):
+    __slots__ = ()
+
+    IS_STATIC = True
+
     def make_img(self, level):
         w, h1 = game_rc.pipe1_img.get_size()
         h2 = game_rc.pipe2_img.get_height()
@@ -403,29 +1621,35 @@ class Pipe(GameEntity):
         return img
 
     def __init__(self, world, pos, level=1):
-        img = self.make_img(level)
+        #built once per level, pipes come and go with chunk loads
+        img = game_rc.pipe_imgs.get(level)
+        if img is None:
+            img = game_rc.pipe_imgs[level] = self.make_img(level)
+            #the rect is as wide as the pipe body, centered under the top
+            w = img.get_width()
+            w2 = game_rc.pipe2_img.get_width()
+            game_rc.add_hitbox(img, (w2 - w) / 2, w2)
         GameEntity.__init__(self, world, pos, EntityName.PIPE,
                             EntityType.STILL, img)
-        w, h = img.get_size()
-        self.reinit_rect(pos, w, h)
-
-    def reinit_rect(self, pos, w, h):
-        w2 = game_rc.pipe2_img.get_width()
-        w_offset = (w2 - w) / 2
-        left, bottom = pos
-        left += w_offset
-        self.rect = build_rect_from_pos((left, bottom), w2, h)
 
 class Rock(GameEntity):
+    __slots__ = ()
+
+    IS_TILE = True
+    IS_STATIC = True
+
     def __init__(self, world, pos):
         img = game_rc.rock_img
         GameEntity.__init__(self, world, pos, EntityName.ROCK,
                             EntityType.STILL, img)
 
 class StillBounceCtrl(object):
+    __slots__ = ("entity", "bounce_offset_idx", "bounce_cur_frame", "started")
+
+    bounce_offset = [(5, -1), (4, 0), (4, 1), (1, 2), (1, -1)]
+
     def __init__(self, entity):
         self.entity = entity
-        self.bounce_offset = [(5, -1), (4, 0), (4, 1), (1, 2), (1, -1)]
         self.bounce_offset_idx = 0
         self.bounce_cur_frame = 0
         self.started = False
@@ -437,6 +1661,7 @@ class StillBounceCtrl(object):
         self.bounce_offset_idx = 0
         self.bounce_cur_frame = 0
         self.started = True
+        self.entity.wake()
 
     def update(self):
         if self.started == False:
@@ -444,7 +1669,7 @@ class StillBounceCtrl(object):
 
         offset_data = self.bounce_offset[self.bounce_offset_idx]
         offset_y = offset_data[1]
-        self.entity.update_pos((0, offset_y), with_direction=True)
+        self.entity.move_by(0, offset_y)
 
         self.bounce_cur_frame += 1
         if self.bounce_cur_frame < offset_data[0]:
@@ -454,9 +1679,15 @@ class StillBounceCtrl(object):
         self.bounce_offset_idx += 1
         if self.bounce_offset_idx >= len(self.bounce_offset):
             self.started = False
+            self.entity.sleep()
             return
 
 class Brick(GameEntity):
+    __slots__ = ("bounce_ctrl",)
+
+    IS_TILE = True
+    IS_STATIC = True
+
     def __init__(self, world, pos):
         img = game_rc.brick_img
         GameEntity.__init__(self, world, pos, EntityName.BRICK,
@@ -472,6 +1703,16 @@ class Brick(GameEntity):
         self.bounce_ctrl.update()
 
 class Plate(GameEntity):
+    __slots__ = ("img_set", "is_dead", "shine_idx", "shine_idx_inc",
+                 "shine_timer", "bounce_ctrl")
+
+    START_AWAKE = True
+    IS_TILE = True
+
+    shine_frames = [24, 8, 8]
+    shine_idx_min = 0
+    shine_idx_max = len(shine_frames)-1
+
     def __init__(self, world, pos):
         self.img_set = [game_rc.plate1_img, game_rc.plate2_img,\
                         game_rc.plate3_img]
@@ -480,30 +1721,26 @@ class Plate(GameEntity):
                             EntityType.STILL, img)
 
         self.is_dead = False
-        self.shine_frames = [24, 8, 8]
         self.shine_idx = 0
-        self.shine_idx_min = 0
-        self.shine_idx_max = len(self.shine_frames)-1
         self.shine_idx_inc = 1
-        self.shine_cur_frame = 0
+        self.shine_timer = None
         self.bounce_ctrl = StillBounceCtrl(self)
 
     def handle_push(self):
         if self.is_dead == True:
             return
+        if self.shine_timer is not None:
+            self.shine_timer.cancel()
+            self.shine_timer = None
         self.bounce_ctrl.start()
         self.is_dead = True
         self.img = game_rc.plate4_img
         self.world.push_on_top_entity(self)
 
     def shine(self):
+        #runs when the sprite changes, asleep for the frames it is shown
         self.img = self.img_set[self.shine_idx]
-
-        self.shine_cur_frame += 1
-        if self.shine_cur_frame < self.shine_frames[self.shine_idx]:
-            return
-
-        self.shine_cur_frame = 0
+        self.shine_timer = self.sleep_for(self.shine_frames[self.shine_idx])
 
         if self.shine_idx == self.shine_idx_max:
             self.shine_idx_inc = -1
@@ -519,6 +1756,8 @@ class Plate(GameEntity):
             self.shine()
 
 class GoombaState(object):
+    __slots__ = ("state_machine", "goomba", "state_name", "img_set", "img_idx")
+
     def __init__(self, state_machine, state_name):
         self.state_machine = state_machine
         self.goomba = state_machine.goomba
@@ -527,6 +1766,9 @@ class GoombaState(object):
         self.img_set = []
         self.img_idx = 0
 
+    def reset(self):
+        self.img_idx = 0
+
     def run(self):
         pass
 
@@ -546,31 +1788,35 @@ class GoombaState(object):
         return None
 
 class GoombaNormalState(GoombaState):
+    __slots__ = ("img_cnt", "move_counter", "flip_counter", "fall_data",
+                 "fall_cycle", "fall_cur_frame")
+
     MOVE_DOWN_MAX = 5
 
+    offset_x = 1
+    move_rate = 2
+    flip_rate = 8
+
     def __init__(self, state_machine):
         GoombaState.__init__(self, state_machine,
                              state_machine.normal_state_name)
         
-        img_flipped = pygame.transform.flip(game_rc.goomba1_img, True, False)
+        img_flipped = game_rc.get_transformed(game_rc.goomba1_img, flip_x=True)
         self.img_set = [img_flipped, game_rc.goomba1_img]
-        self.img_idx = 0
         self.img_cnt = len(self.img_set)
+        self.fall_data = ENEMY_FALL_DATA
+        self.reset()
 
-        self.offset_x = 1
+    def reset(self):
+        GoombaState.reset(self)
         self.move_counter = 0
-        self.move_rate = 2
-
         self.flip_counter = 0
-        self.flip_rate = 8
-
-        self.fall_data = [(2, 1), (8, 3), (0, 5)]
         self.fall_cycle = 0
         self.fall_cur_frame = 0
 
     def entry_action(self):
         GoombaState.entry_action(self)
-        self.goomba.etype = EntityType.ENEMY
+        self.goomba.set_etype(EntityType.ENEMY)
 
     def calc_offset_x(self):
         self.move_counter += 1
@@ -598,9 +1844,17 @@ class GoombaNormalState(GoombaState):
         return offset_y
 
     def move_goomba(self):
-        offset_x = self.calc_offset_x() * self.goomba.heading[0]
+        goomba = self.goomba
+        if goomba.slot >= 0:
+            #computed for all walkers by ComponentStore.run_systems
+            components = goomba.world.components
+            offset_x, offset_y = components.get_walk_offset(goomba.slot)
+            goomba.apply_offset(offset_x, offset_y)
+            return
+
+        offset_x = self.calc_offset_x() * goomba.heading[0]
         offset_y = self.calc_offset_y()
-        self.goomba.update_pos((offset_x, offset_y), with_direction=True)
+        goomba.move_by(offset_x, offset_y)
 
     def flip_img(self):
         self.flip_counter += 1
@@ -627,15 +1881,15 @@ class GoombaNormalState(GoombaState):
             return
 
         if goomba.rect.left == 1:
-            goomba.heading[0] = 1
+            goomba.set_heading_x(1)
         else:
-            goomba.heading[0] = -1
+            goomba.set_heading_x(-1)
 
     def check_on_ground(self):
         goomba = self.goomba
         world = goomba.world
         if world.is_not_on_ground(goomba):
-            goomba.speed_y = 1
+            goomba.set_speed_y(1)
 
     def check_collision(self):
         world = self.goomba.world
@@ -664,7 +1918,7 @@ class GoombaNormalState(GoombaState):
         if abs(offset_y) > self.MOVE_DOWN_MAX:
             return
 
-        goomba.speed_y = 0
+        goomba.set_speed_y(0)
         world.fix_collision_y(goomba, entity, GameDef.DIRECTION_UP)
 
     def check_collision_x(self, collision_list):
@@ -679,7 +1933,7 @@ class GoombaNormalState(GoombaState):
             return
 
         world.fix_collision_x(goomba, entity, direction)
-        goomba.heading[0] = -goomba.heading[0]
+        goomba.set_heading_x(-goomba.heading[0])
 
     def handle_stamp(self):
         state_machine = self.state_machine
@@ -694,18 +1948,22 @@ class GoombaNormalState(GoombaState):
         return state_machine.states[state_machine.dead_state_name]
 
 class GoombaDeadState(GoombaState):
+    __slots__ = ("offset_x", "offset_y", "offset_y_idx", "offset_y_frame")
+
+    offset_y_data = [(6, -2), (3, -1), (3, 0), (2, 1), (8, 3), (0, 5)]
+
     def __init__(self, state_machine):
         GoombaState.__init__(self, state_machine,
                              state_machine.dead_state_name)
 
-        img = pygame.transform.flip(game_rc.goomba1_img, False, True)
+        img = game_rc.get_transformed(game_rc.goomba1_img, flip_y=True)
         self.img_set = [img]
-        self.img_idx = 0
+        self.reset()
 
+    def reset(self):
+        GoombaState.reset(self)
         self.offset_x = 0
         self.offset_y = 0
-
-        self.offset_y_data = [(6, -2), (3, -1), (3, 0), (2, 1), (8, 3), (0, 5)]
         self.offset_y_idx = 0
         self.offset_y_frame = 0
     
@@ -713,7 +1971,7 @@ class GoombaDeadState(GoombaState):
         GoombaState.entry_action(self)
         
         goomba = self.goomba
-        goomba.etype = EntityType.FOREGROUND
+        goomba.set_etype(EntityType.FOREGROUND)
 
         mario = goomba.world.mario
         if mario.rect.center[0] > goomba.rect.center[0]:
@@ -738,33 +1996,43 @@ class GoombaDeadState(GoombaState):
         world = goomba.world
 
         self.calc_offset_y()
-        goomba.update_pos((self.offset_x, self.offset_y), with_direction=True)
+        goomba.move_by(self.offset_x, self.offset_y)
         if world.is_out_of_screen(goomba):
             world.remove_entity(goomba)
 
 class GoombaBodyState(GoombaState):
+    __slots__ = ("timer",)
+
+    LIVE_FRAMES = 32
+
     def __init__(self, state_machine):
         GoombaState.__init__(self, state_machine,
                              state_machine.body_state_name)
 
         self.img_set = [game_rc.goomba2_img]
-        self.img_idx = 0
+        self.timer = None
+        self.reset()
 
-        self.live_frames = 32
+    def reset(self):
+        GoombaState.reset(self)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
 
     def entry_action(self):
         GoombaState.entry_action(self)
-        self.goomba.etype = EntityType.BODY
+        self.goomba.set_etype(EntityType.BODY)
+        #nothing to do until the body goes
+        self.timer = self.goomba.sleep_for(self.LIVE_FRAMES)
 
     def run(self):
         goomba = self.goomba
-        world = goomba.world
-
-        self.live_frames -= 1
-        if self.live_frames == 0:
-            world.remove_entity(goomba)
+        self.timer = None
+        goomba.world.remove_entity(goomba)
 
 class GoombaStateMachine(object):
+    __slots__ = ("goomba", "states", "active_state")
+
     normal_state_name = "normal_state"
     dead_state_name = "dead_state"
     body_state_name = "body_state"
@@ -780,11 +2048,17 @@ class GoombaStateMachine(object):
         self.active_state = None
         self.switch_to(self.states[self.normal_state_name])
 
+    def reset(self):
+        for state in self.states.itervalues():
+            state.reset()
+        self.switch_to(self.states[self.normal_state_name])
+
     def add_state(self, state):
         self.states[state.state_name] = state
 
     def switch_to(self, state):
         self.active_state = state
+        self.goomba.set_walking(state.state_name == self.normal_state_name)
         self.active_state.entry_action()
 
     def think(self):
@@ -806,6 +2080,11 @@ class GoombaStateMachine(object):
             self.switch_to(new_state)
 
 class Goomba(GameEntity):
+    __slots__ = ("speed_x", "speed_y", "state_machine")
+
+    START_AWAKE = True
+    POOLED = True
+
     def __init__(self, world, pos):
         GameEntity.__init__(self, world, pos, EntityName.GOOMBA,
                             EntityType.ENEMY, game_rc.goomba1_img)
@@ -814,10 +2093,22 @@ class Goomba(GameEntity):
         self.speed_x = 1 #no use, just x/y pair
         self.speed_y = 0 #0/1, indicate move on y
         self.state_machine = GoombaStateMachine(self)
+
+    def reset(self, pos):
+        GameEntity.reset(self, pos, EntityType.ENEMY, game_rc.goomba1_img)
+        self.heading[0] = -1
+        self.speed_y = 0
+        self.state_machine.reset()
     
     def set_img(self, img):
         GameEntity.set_img(self, img)
 
+    def attach_components(self, components):
+        states = self.state_machine.states
+        state = states[GoombaStateMachine.normal_state_name]
+        components.init_walker(self.slot, state.offset_x, state.move_rate)
+        self.set_walking(self.walking)
+
     def update(self):
         self.state_machine.think()
 
@@ -831,6 +2122,8 @@ class Goomba(GameEntity):
         self.state_machine.get_shot()
 
 class KoopaState(object):
+    __slots__ = ("state_machine", "koopa", "state_name", "img_set", "img_idx")
+
     def __init__(self, state_machine, state_name):
         self.state_machine = state_machine
         self.koopa = state_machine.koopa
@@ -839,6 +2132,9 @@ class KoopaState(object):
         self.img_set = []
         self.img_idx = 0
 
+    def reset(self):
+        self.img_idx = 0
+
     def entry_action(self):
         self.set_koopa_img()
         pass
@@ -863,29 +2159,33 @@ class KoopaState(object):
         return None
 
 class KoopaNormalState(KoopaState):
+    __slots__ = ("img_cnt", "move_counter", "transform_counter", "fall_data",
+                 "fall_cycle", "fall_cur_frame")
+
     MOVE_DOWN_MAX = 5
 
+    offset_x = 1
+    move_rate = 2
+    transform_rate = 8
+
     def __init__(self, state_machine):
         KoopaState.__init__(self, state_machine,
                             state_machine.normal_state_name)
         
         self.img_set = [game_rc.koopa1_img, game_rc.koopa2_img]
-        self.img_idx = 0
         self.img_cnt = len(self.img_set)
+        self.fall_data = ENEMY_FALL_DATA
+        self.reset()
 
-        self.offset_x = 1
+    def reset(self):
+        KoopaState.reset(self)
         self.move_counter = 0
-        self.move_rate = 2
-
         self.transform_counter = 0
-        self.transform_rate = 8
-
-        self.fall_data = [(2, 1), (8, 3), (0, 5)]
         self.fall_cycle = 0
         self.fall_cur_frame = 0
 
     def entry_action(self):
-        self.koopa.etype = EntityType.ENEMY
+        self.koopa.set_etype(EntityType.ENEMY)
         KoopaState.entry_action(self)
 
     def calc_offset_x(self):
@@ -914,9 +2214,17 @@ class KoopaNormalState(KoopaState):
         return offset_y
 
     def move_koopa(self):
-        offset_x = self.calc_offset_x() * self.koopa.heading[0]
+        koopa = self.koopa
+        if koopa.slot >= 0:
+            #computed for all walkers by ComponentStore.run_systems
+            components = koopa.world.components
+            offset_x, offset_y = components.get_walk_offset(koopa.slot)
+            koopa.apply_offset(offset_x, offset_y)
+            return
+
+        offset_x = self.calc_offset_x() * koopa.heading[0]
         offset_y = self.calc_offset_y()
-        self.koopa.update_pos((offset_x, offset_y), with_direction=True)
+        koopa.move_by(offset_x, offset_y)
 
     def transform_img(self):
         self.transform_counter += 1
@@ -944,15 +2252,15 @@ class KoopaNormalState(KoopaState):
             return
 
         if koopa.rect.left == 1:
-            koopa.heading[0] = 1
+            koopa.set_heading_x(1)
         else:
-            koopa.heading[0] = -1
+            koopa.set_heading_x(-1)
 
     def check_on_ground(self):
         koopa = self.koopa
         world = koopa.world
         if world.is_not_on_ground(koopa):
-            koopa.speed_y = 1
+            koopa.set_speed_y(1)
 
     def check_collision(self):
         world = self.koopa.world
@@ -981,7 +2289,7 @@ class KoopaNormalState(KoopaState):
         if abs(offset_y) > self.MOVE_DOWN_MAX:
             return
 
-        koopa.speed_y = 0
+        koopa.set_speed_y(0)
         world.fix_collision_y(koopa, entity, GameDef.DIRECTION_UP)
 
     def check_collision_x(self, collision_list):
@@ -996,7 +2304,7 @@ class KoopaNormalState(KoopaState):
             return
 
         world.fix_collision_x(koopa, entity, direction)
-        koopa.heading[0] = -koopa.heading[0]
+        koopa.set_heading_x(-koopa.heading[0])
 
     def handle_stamp(self):
         state_machine = self.state_machine
@@ -1011,49 +2319,49 @@ class KoopaNormalState(KoopaState):
         return state_machine.states[state_machine.dead_state_name]
 
 class KoopaFreezeState(KoopaState):
+    __slots__ = ("img_cnt", "cycle", "timer")
+
     FREEZE_FRAMES = 250
 
+    cycle_max = 10
+    cycle_frame_max = 8
+
     def __init__(self, state_machine):
         KoopaState.__init__(self, state_machine,
                             state_machine.freeze_state_name)
 
         self.img_set = [game_rc.koopa3_img, game_rc.koopa4_img]
-        self.img_idx = 0
         self.img_cnt = len(self.img_set)
+        self.timer = None
+        self.reset()
 
-        self.freeze_frames = self.FREEZE_FRAMES
-
+    def reset(self):
+        KoopaState.reset(self)
         self.cycle = 0
-        self.cycle_max = 10
-        self.cycle_frame = 0
-        self.cycle_frame_max = 8
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
 
     def entry_action(self):
-        self.img_idx = 0
-        self.cycle = 0
-        self.cycle_frame = 0
-        self.freeze_frames = self.FREEZE_FRAMES
-        self.koopa.etype = EntityType.STILL
+        self.reset()
+        self.koopa.set_etype(EntityType.STILL)
         KoopaState.entry_action(self)
+        #asleep until the first shake, FREEZE_FRAMES then one cycle
+        self.timer = self.koopa.sleep_for(self.FREEZE_FRAMES +
+                                          self.cycle_frame_max)
 
     def run(self):
-        if self.freeze_frames > 0:
-            self.freeze_frames -= 1
-            return None
-
-        self.cycle_frame += 1
-        if self.cycle_frame < self.cycle_frame_max:
-            return None
-
-        self.cycle_frame = 0
+        #one shake every cycle_frame_max frames, asleep in between
         self.cycle += 1
         self.img_idx += 1
         self.img_idx %= self.img_cnt
         self.set_koopa_img()
 
         if self.cycle < self.cycle_max:
+            self.timer = self.koopa.sleep_for(self.cycle_frame_max)
             return None
         else:
+            self.timer = None
             states = self.state_machine.states
             return states[self.state_machine.normal_state_name]
 
@@ -1075,32 +2383,37 @@ class KoopaFreezeState(KoopaState):
         return state_machine.states[state_machine.dead_state_name]
 
 class KoopaBodyState(KoopaState):
+    __slots__ = ("fall_data", "fall_cycle", "fall_cur_frame",
+                 "is_shot_by_another")
+
     MOVE_DOWN_MAX = 5
 
+    offset_x = 3
+
     def __init__(self, state_machine):
         KoopaState.__init__(self, state_machine,
                             state_machine.body_state_name)
 
         self.img_set = [game_rc.koopa3_img]
-        self.img_idx = 0
-        self.offset_x = 3
+        self.fall_data = ENEMY_FALL_DATA
+        self.reset()
 
-        self.fall_data = [(2, 1), (8, 3), (0, 5)]
+    def reset(self):
+        KoopaState.reset(self)
         self.fall_cycle = 0
         self.fall_cur_frame = 0
-
         self.is_shot_by_another = False
 
     def entry_action(self):
         koopa = self.koopa
         KoopaState.entry_action(self)
-        self.koopa.etype = EntityType.ENEMY
+        self.koopa.set_etype(EntityType.ENEMY)
 
         mario = koopa.world.mario
         if mario.rect.center[0] > koopa.rect.center[0]:
-            koopa.heading[0] = GameDef.DIRECTION_LEFT
+            koopa.set_heading_x(GameDef.DIRECTION_LEFT)
         else:
-            koopa.heading[0] = GameDef.DIRECTION_RIGHT
+            koopa.set_heading_x(GameDef.DIRECTION_RIGHT)
 
     def calc_offset_x(self):
         return self.offset_x
@@ -1125,7 +2438,7 @@ class KoopaBodyState(KoopaState):
     def move_koopa(self):
         offset_x = self.calc_offset_x() * self.koopa.heading[0]
         offset_y = self.calc_offset_y()
-        self.koopa.update_pos((offset_x, offset_y), with_direction=True)
+        self.koopa.move_by(offset_x, offset_y)
 
     def run(self):
         self.move_koopa()
@@ -1147,15 +2460,15 @@ class KoopaBodyState(KoopaState):
             return
 
         if koopa.rect.left < 1:
-            koopa.heading[0] = 1
+            koopa.set_heading_x(1)
         else:
-            koopa.heading[0] = -1
+            koopa.set_heading_x(-1)
 
     def check_on_ground(self):
         koopa = self.koopa
         world = koopa.world
         if world.is_not_on_ground(koopa):
-            koopa.speed_y = 1
+            koopa.set_speed_y(1)
 
     def check_collision(self):
         world = self.koopa.world
@@ -1184,7 +2497,7 @@ class KoopaBodyState(KoopaState):
         if abs(offset_y) > self.MOVE_DOWN_MAX:
             return
 
-        koopa.speed_y = 0
+        koopa.set_speed_y(0)
         world.fix_collision_y(koopa, entity, GameDef.DIRECTION_UP)
 
     def shoot_entity(self, entity):
@@ -1212,7 +2525,7 @@ class KoopaBodyState(KoopaState):
 
         self.shoot_entity(entity)
         world.fix_collision_x(koopa, entity, direction)
-        koopa.heading[0] = -koopa.heading[0]
+        koopa.set_heading_x(-koopa.heading[0])
 
     def handle_stamp(self):
         state_machine = self.state_machine
@@ -1227,18 +2540,22 @@ class KoopaBodyState(KoopaState):
         return state_machine.states[state_machine.dead_state_name]
 
 class KoopaDeadState(KoopaState):
+    __slots__ = ("offset_x", "offset_y", "offset_y_idx", "offset_y_frame")
+
+    offset_y_data = [(6, -2), (3, -1), (3, 0), (2, 1), (8, 3), (0, 5)]
+
     def __init__(self, state_machine):
         KoopaState.__init__(self, state_machine,
                             state_machine.dead_state_name)
 
-        img = pygame.transform.flip(game_rc.koopa3_img, False, True)
+        img = game_rc.get_transformed(game_rc.koopa3_img, flip_y=True)
         self.img_set = [img]
-        self.img_idx = 0
+        self.reset()
 
+    def reset(self):
+        KoopaState.reset(self)
         self.offset_x = 0
         self.offset_y = 0
-
-        self.offset_y_data = [(6, -2), (3, -1), (3, 0), (2, 1), (8, 3), (0, 5)]
         self.offset_y_idx = 0
         self.offset_y_frame = 0
     
@@ -1246,7 +2563,7 @@ class KoopaDeadState(KoopaState):
         KoopaState.entry_action(self)
         
         koopa = self.koopa
-        koopa.etype = EntityType.FOREGROUND
+        koopa.set_etype(EntityType.FOREGROUND)
 
         mario = koopa.world.mario
         if mario.rect.center[0] > koopa.rect.center[0]:
@@ -1271,11 +2588,13 @@ class KoopaDeadState(KoopaState):
         world = koopa.world
 
         self.calc_offset_y()
-        koopa.update_pos((self.offset_x, self.offset_y), with_direction=True)
+        koopa.move_by(self.offset_x, self.offset_y)
         if world.is_out_of_screen(koopa):
             world.remove_entity(koopa)
 
 class KoopaStateMachine(object):
+    __slots__ = ("koopa", "states", "active_state")
+
     normal_state_name = "normal_state"
     freeze_state_name = "freeze_state"
     body_state_name = "body_state"
@@ -1293,11 +2612,19 @@ class KoopaStateMachine(object):
         self.active_state = None
         self.switch_to(self.states[self.normal_state_name])
 
+    def reset(self):
+        for state in self.states.itervalues():
+            state.reset()
+        self.switch_to(self.states[self.normal_state_name])
+
     def add_state(self, state):
         self.states[state.state_name] = state
 
     def switch_to(self, state):
         self.active_state = state
+        self.koopa.set_walking(state.state_name == self.normal_state_name)
+        #asleep only while frozen, see KoopaFreezeState
+        self.koopa.wake()
         self.active_state.entry_action()
 
     def think(self):
@@ -1335,6 +2662,11 @@ class KoopaStateMachine(object):
             self.switch_to(new_state)
 
 class Koopa(GameEntity):
+    __slots__ = ("speed_x", "speed_y", "state_machine")
+
+    START_AWAKE = True
+    POOLED = True
+
     def __init__(self, world, pos):
         GameEntity.__init__(self, world, pos, EntityName.KOOPA,
                             EntityType.ENEMY, game_rc.koopa1_img)
@@ -1343,12 +2675,24 @@ class Koopa(GameEntity):
         self.speed_x = 1 #no use, just x/y pair
         self.speed_y = 0 #0/1, indicate move on y
         self.state_machine = KoopaStateMachine(self)
+
+    def reset(self, pos):
+        GameEntity.reset(self, pos, EntityType.ENEMY, game_rc.koopa1_img)
+        self.heading[0] = -1
+        self.speed_y = 0
+        self.state_machine.reset()
     
     def set_img(self, img):
         if self.heading [0]> 0:
-            img = pygame.transform.flip(img, True, False)
+            img = game_rc.get_transformed(img, flip_x=True)
         GameEntity.set_img(self, img)
 
+    def attach_components(self, components):
+        states = self.state_machine.states
+        state = states[KoopaStateMachine.normal_state_name]
+        components.init_walker(self.slot, state.offset_x, state.move_rate)
+        self.set_walking(self.walking)
+
     def update(self):
         self.state_machine.think()
 
@@ -1368,6 +2712,10 @@ class Koopa(GameEntity):
         self.state_machine.get_shot()
 
 class MarioState(object):
+    __slots__ = ("state_machine", "state_name", "img_idx", "img_set",
+                 "transform_counter", "transform_rate", "transform_offset",
+                 "move_offset", "state_detail")
+
     def __init__(self, state_machine, state_name, img_set,
                  transform_rate, transform_offset, move_offset):
         self.state_machine = state_machine
@@ -1477,6 +2825,8 @@ class MarioState(object):
         pass
 
 class MarioStandState(MarioState):
+    __slots__ = ()
+
     def __init__(self, state_machine):
         state_name = state_machine.stand_state_name
         img_set = [game_rc.mario1_img]
@@ -1511,11 +2861,13 @@ class MarioStandState(MarioState):
             return None
 
 class MarioWalkState(MarioState):
+    __slots__ = ()
+
     state_detail_walk = "normal"
     state_detail_slow_run = "slow_run"
     state_detail_fast_run = "fast_run"
 
-    transform_offset = [0, 5, 1]
+    walk_transform_offset = [0, 5, 1]
     walk_transform_rate = 4
     walk_move_offset = 1
     slow_run_transform_rate = 3
@@ -1527,7 +2879,7 @@ class MarioWalkState(MarioState):
         state_name = state_machine.walk_state_name
         img_set = [game_rc.mario2_img, game_rc.mario3_img, game_rc.mario4_img]
         transform_rate = self.walk_transform_rate
-        transform_offset = self.transform_offset
+        transform_offset = self.walk_transform_offset
         move_offset = self.walk_move_offset
         MarioState.__init__(self, state_machine, state_name, img_set,
                             transform_rate, transform_offset, move_offset)
@@ -1594,6 +2946,8 @@ class MarioWalkState(MarioState):
         return state_machine.states[state_machine.hit_wall_state_name]
 
 class MarioBrakeState(MarioState):
+    __slots__ = ("end_frames",)
+
     def __init__(self, state_machine):
         state_name = state_machine.brake_state_name
         img_set = [game_rc.mario5_img]
@@ -1647,6 +3001,8 @@ class MarioBrakeState(MarioState):
         return state_machine.states[state_machine.stand_state_name]
 
 class MarioHitWallState(MarioState):
+    __slots__ = ()
+
     def __init__(self, state_machine):
         state_name = state_machine.hit_wall_state_name
         img_set = [game_rc.mario2_img, game_rc.mario3_img, game_rc.mario4_img]
@@ -1698,6 +3054,12 @@ class MarioHitWallState(MarioState):
         return None
 
 class MarioFlyState(MarioState):
+    __slots__ = ("power", "power_data", "power_up_data", "power_up_data_speed",
+                 "power_up_data_no_speed", "power_up_data_len",
+                 "power_down_data", "power_data_idx", "total_frames",
+                 "cur_cycle", "cur_frame", "offset_x", "offset_y",
+                 "speed_x_counter")
+
     POWER_MIN = 2
     POWER_MAX = 14
     FULL_POWER_FRAMES = 7
@@ -1976,6 +3338,9 @@ class MarioFlyState(MarioState):
             mario.set_speed_x(speed_x)
 
 class MarioFallState(MarioState):
+    __slots__ = ("fall_data", "fall_data_idx", "total_frames", "cur_cycle",
+                 "cur_frame", "offset_x", "offset_y", "speed_x_counter")
+
     MOVE_DOWN_MAX_OFFSET = 5
 
     def __init__(self, state_machine):
@@ -2167,6 +3532,9 @@ class MarioFallState(MarioState):
             mario.set_speed_x(speed_x)
 
 class MarioStateMachine(object):
+    __slots__ = ("mario", "world", "states", "collision_align_x_list",
+                 "collision_align_y_list", "active_state")
+
     stand_state_name = "stand_state"
     walk_state_name = "walk_state"
     brake_state_name = "brake_state"
@@ -2256,7 +3624,7 @@ class MarioStateMachine(object):
             elif direction == GameDef.DIRECTION_RIGHT:
                 offset_x = collision_align - self.mario.rect.left
 
-            self.mario.update_pos((offset_x, 0), with_direction=True)
+            self.mario.move_by(offset_x, 0)
 
     def apply_collision_align_y(self):
         for (collision_align, direction) in self.collision_align_y_list:
@@ -2265,7 +3633,7 @@ class MarioStateMachine(object):
             elif direction == GameDef.DIRECTION_DOWN:
                 offset_y = collision_align - self.mario.rect.up
 
-            self.mario.update_pos((0, offset_y), with_direction=True)
+            self.mario.move_by(0, offset_y)
 
     def apply_collision_align(self):
         self.apply_collision_align_x()
@@ -2274,6 +3642,10 @@ class MarioStateMachine(object):
         self.collision_align_y_list = []
 
 class Mario(GameEntity):
+    __slots__ = ("speed_x", "speed_y", "acce_x", "acce_y", "ctrl_x", "ctrl_y",
+                 "state_machine")
+
+    START_AWAKE = True
     IMG_UPDATE_RATE = 3
     SPEED_WALK_MAX = 10
     SPEED_RUN_SLOW_MAX = 20
@@ -2298,8 +3670,12 @@ class Mario(GameEntity):
         self.acce_y = 0
         self.ctrl_x = 0
         self.ctrl_y = 0
-        self.heading = Vector2(GameDef.DIRECTION_RIGHT, 0)
-        self.pos = Vector2(MARIO_START_X, GROUND_Y)
+        self.heading = [GameDef.DIRECTION_RIGHT, 0]
+        self.pos = [MARIO_START_X, GROUND_Y]
+        self.eid = 0
+        self.slot = -1
+        self.etype = EntityType.MARIO
+        self.rect = pygame.Rect(0, 0, 0, 0)
 
         self.world = world
         self.state_machine = MarioStateMachine(self)
@@ -2309,7 +3685,7 @@ class Mario(GameEntity):
 
     def set_img(self, img):
         if self.heading[0] == GameDef.DIRECTION_LEFT:
-            img = pygame.transform.flip(img, True, False)
+            img = game_rc.get_transformed(img, flip_x=True)
         GameEntity.set_img(self, img)
 
     def get_speedx_direction(self):
@@ -2345,13 +3721,13 @@ class Mario(GameEntity):
         return self.speed_x
 
     def zero_speed_y(self):
-        self.speed_y = 0
+        self.set_speed_y(0)
 
     def set_speed_y_up(self):
-        self.speed_y = GameDef.DIRECTION_UP
+        self.set_speed_y(GameDef.DIRECTION_UP)
 
     def set_speed_y_down(self):
-        self.speed_y = GameDef.DIRECTION_DOWN
+        self.set_speed_y(GameDef.DIRECTION_DOWN)
 
     def get_ctrl_x(self):
         return self.ctrl_x
@@ -2362,7 +3738,7 @@ class Mario(GameEntity):
     def update_heading_x(self):
         if self.speed_x != 0:
             speedx_direction = self.get_speedx_direction()
-            self.heading[0] = speedx_direction
+            self.set_heading_x(speedx_direction)
 
     def update_heading_y(self):
         if self.speed_y == 0:
@@ -2397,10 +3773,6 @@ class Mario(GameEntity):
         surface.blit(text, (16,y))
         #print "mario state:", state.state_name, "pos:", self.pos
 
-    def render(self, surface):
-        GameEntity.render(self, surface)
-        #self.debug(surface)
-
     def update(self):
         self.state_machine.think()
 
@@ -2430,136 +3802,347 @@ class Mario(GameEntity):
         elif event.key == K_f:
             self.ctrl_y = GameDef.DIRECTION_NONE
 
-def construct_world():
-    world = World()
+class Tracer(object):
+    #spans of the last capacity frame phases and entity updates, kept in
+    #preallocated arrays used as a ring buffer, see the global tracer
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.names = [None] * capacity
+        self.cats = [None] * capacity
+        self.starts = array.array("d", [0.0]) * capacity
+        self.ends = array.array("d", [0.0]) * capacity
+        self.next = 0
+        self.count = 0
+        self.clock = getattr(time, "perf_counter", timeit.default_timer)
+        self.lap_start = self.clock()
+
+    def add(self, name, cat, start, end):
+        i = self.next
+        self.names[i] = name
+        self.cats[i] = cat
+        self.starts[i] = start
+        self.ends[i] = end
+        self.next = (i + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def lap(self, name):
+        #a frame phase span from the end of the previous lap until now
+        now = self.clock()
+        self.add(name, "frame", self.lap_start, now)
+        self.lap_start = now
+
+    def iter_spans(self):
+        #oldest first
+        first = (self.next - self.count) % self.capacity
+        for n in xrange(self.count):
+            i = (first + n) % self.capacity
+            yield (self.names[i], self.cats[i], self.starts[i], self.ends[i])
+
+    def dump(self, path):
+        #chrome://tracing or Perfetto trace-event format, in microseconds
+        events = []
+        base = None
+        for name, cat, start, end in self.iter_spans():
+            if base is None:
+                base = start
+            events.append({"name": name, "cat": cat, "ph": "X",
+                           "ts": (start - base) * 1e6,
+                           "dur": (end - start) * 1e6,
+                           "pid": 1, "tid": 1})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        logging.info("%d spans written to %s", len(events), path)
+
+class StackSampler(object):
+    #looks at the stack of the thread that started it every interval
+    #seconds from a daemon thread, and counts each stack seen
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = {}
+        self.thread_id = None
+        self.thread = None
+        self.running = False
 
-    ground = Ground(world, (0, ORIGINAL_SIZE[1]-1), GROUND_BLOCK_ROWS, 16)
-    world.add_entity(ground)
+    def start(self):
+        self.thread_id = threading.current_thread().ident
+        self.running = True
+        self.thread = threading.Thread(target=self.sample_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def sample_loop(self):
+        counts = self.counts
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append("%s (%s:%d)" % (code.co_name,
+                                             os.path.basename(
+                                                 code.co_filename),
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            stack = ";".join(reversed(names))
+            counts[stack] = counts.get(stack, 0) + 1
+
+    def write(self, path):
+        #collapsed stacks, "outer;...;inner count" per line, the input of
+        #flamegraph.pl and speedscope
+        with open(path, "w") as f:
+            for stack, count in sorted(self.counts.iteritems()):
+                f.write("%s %d\n" % (stack, count))
+
+class Upscaler(object):
+    NEAREST = "nearest"
+    SCALE2X = "scale2x"
+    SMOOTH = "smooth"
+    NATIVE = "native"
+    MODES = (NEAREST, SCALE2X, SMOOTH, NATIVE)
+
+    def __init__(self, mode, scale, flags=0):
+        if mode not in self.MODES:
+            raise ValueError("unknown upscaler mode %s" % mode)
+        if mode == self.NATIVE:
+            scale = 1
+        self.mode = mode
+        self.scale = scale
+        w, h = ORIGINAL_SIZE
+        self.screen = pygame.display.set_mode((w*scale, h*scale), flags, 24)
+        self.screen_rect = self.screen.get_rect()
+
+        #the world renders into frame, every buffer is allocated once here
+        #in the display pixel format, so presenting needs no convert()
+        self.buf2 = None
+        self.buf4 = None
+        if mode == self.NATIVE:
+            self.frame = self.screen
+        else:
+            self.frame = pygame.Surface(ORIGINAL_SIZE, 0, self.screen)
+        if mode == self.SCALE2X:
+            self.buf2 = pygame.Surface((w*2, h*2), 0, self.screen)
+        if mode == self.SCALE2X and scale == 4:
+            self.buf4 = pygame.Surface((w*4, h*4), 0, self.screen)
+        self.frame_rect = self.frame.get_rect()
+
+        #smoothscale, and scale2x followed by an uneven stretch, depend on
+        #the whole frame, those modes always present the full frame
+        self.by_region = mode in (self.NEAREST, self.NATIVE) or \
+                         (mode == self.SCALE2X and scale in (2, 4))
+
+    def scale_rect(self, rect, scale):
+        return pygame.Rect(rect.left*scale, rect.top*scale,
+                           rect.width*scale, rect.height*scale)
+
+    def present(self, rects=None):
+        #rects are frame areas that changed, None for the whole frame
+        self.flip(self.upscale(rects))
+
+    def upscale(self, rects=None):
+        #returns the screen areas written, None for the whole screen
+        if rects is None or not self.by_region:
+            self.scale_frame()
+            return None
+        update_rects = []
+        for rect in rects:
+            update_rects.append(self.scale_region(rect))
+        return update_rects
+
+    def flip(self, update_rects):
+        if update_rects is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(update_rects)
+
+    def scale_frame(self):
+        mode = self.mode
+        screen = self.screen
+        size = screen.get_size()
+        if mode == self.NATIVE:
+            return
+        elif mode == self.NEAREST:
+            pygame.transform.scale(self.frame, size, screen)
+        elif mode == self.SMOOTH:
+            pygame.transform.smoothscale(self.frame, size, screen)
+        elif self.scale == 2:
+            pygame.transform.scale2x(self.frame, screen)
+        elif self.scale == 4:
+            pygame.transform.scale2x(self.frame, self.buf2)
+            pygame.transform.scale2x(self.buf2, screen)
+        else:
+            pygame.transform.scale2x(self.frame, self.buf2)
+            pygame.transform.scale(self.buf2, size, screen)
+
+    def scale_region(self, rect):
+        scale = self.scale
+        dest = self.scale_rect(rect, scale)
+        if self.mode == self.NATIVE:
+            return dest
+        elif self.mode == self.NEAREST:
+            pygame.transform.scale(self.frame.subsurface(rect), dest.size,
+                                   self.screen.subsurface(dest))
+            return dest
+
+        #scale2x output depends on the neighbours of each pixel, so each
+        #pass also changes a ring around the area, and needs a margin
+        #around that ring to get it right
+        ring = scale / 2
+        rect = rect.inflate(ring*2, ring*2).clip(self.frame_rect)
+        dest = self.scale_rect(rect, scale)
+        src = rect.inflate(4, 4).clip(self.frame_rect)
+        buf = self.buf2
+        pygame.transform.scale2x(self.frame.subsurface(src),
+                                 buf.subsurface(self.scale_rect(src, 2)))
+        if scale == 4:
+            src = self.scale_rect(rect, 2).inflate(2, 2).clip(buf.get_rect())
+            pygame.transform.scale2x(buf.subsurface(src),
+                                     self.buf4.subsurface(
+                                         self.scale_rect(src, 2)))
+            buf = self.buf4
+        self.screen.blit(buf, dest, dest)
+        return dest
+
+def construct_world(width=None):
+    world = World(width=width)
+    chunks = ChunkStreamer(world, CHUNK_WIDTH, CHUNK_LOAD_MARGIN,
+                           CHUNK_UNLOAD_MARGIN)
+    world.chunks = chunks
+    #chunks around the starting view are loaded before anything is placed,
+    #their entities are created right away, in place order
+    chunks.update(world.camera.rect)
+
+    #one ground per screen, sprites can not be made as wide as a level
+    for x in xrange(0, world.width, ORIGINAL_SIZE[0]):
+        columns = min(ORIGINAL_SIZE[0], world.width-x)/16
+        chunks.place(Ground, (x, ORIGINAL_SIZE[1]-1), GROUND_BLOCK_ROWS,
+                     columns)
 
     world.mario = Mario(world)
     world.add_entity(world.mario)
 
-    wood = Wood(world, (0, GROUND_Y), game_rc.wood1_img)
-    world.add_entity(wood)
+    chunks.place(Wood, (0, GROUND_Y), game_rc.wood1_img)
+    chunks.place(Wood, (176, GROUND_Y), game_rc.wood2_img)
 
-    wood = Wood(world, (176, GROUND_Y), game_rc.wood2_img)
-    world.add_entity(wood)
-
-    cloud = Cloud(world, (80, 80), level=1)
-    world.add_entity(cloud)
-
-    cloud = Cloud(world, (ORIGINAL_SIZE[0]-64, 64), level=2)
-    world.add_entity(cloud)
+    chunks.place(Cloud, (80, 80), level=1)
+    chunks.place(Cloud, (ORIGINAL_SIZE[0]-64, 64), level=2)
 
     x = MARIO_START_X + 32
-#    pipe = Pipe(world, (x, GROUND_Y), level=8)
-#    world.add_entity(pipe)
+#    chunks.place(Pipe, (x, GROUND_Y), level=8)
 
 #####bottom plate + brick#####
     x += (32+16)
-    plate = Plate(world, (x, GROUND_Y-25))
-    world.add_entity(plate)
+    chunks.place(Plate, (x, GROUND_Y-25))
 
-    rock = Rock(world, (x, GROUND_Y-25-16))
-    world.add_entity(rock)
+    chunks.place(Rock, (x, GROUND_Y-25-16))
 
     x += 16
-    goomba = Goomba(world, (x, GROUND_Y))
-    world.add_entity(goomba)
+    chunks.place(Goomba, (x, GROUND_Y))
 
     brick_cnt = 3
     for i in xrange(brick_cnt):
         if i == 5:
-            brick = Plate(world, (x, GROUND_Y-25))
+            chunks.place(Plate, (x, GROUND_Y-25))
         else:
-            brick = Brick(world, (x, GROUND_Y-25))
-        world.add_entity(brick)
+            chunks.place(Brick, (x, GROUND_Y-25))
         x += 16
     
     x -= 2
-    pipe = Pipe(world, (x, GROUND_Y), level=24)
-    world.add_entity(pipe)
+    chunks.place(Pipe, (x, GROUND_Y), level=24)
 
 #####right side rock#####
     x -= 32
-    rock = Rock(world, (x, 100-16))
-    world.add_entity(rock)
+    chunks.place(Rock, (x, 100-16))
 
     rock_cnt = 6
     for i in xrange(rock_cnt):
-        rock = Rock(world, (x, 100))
-        world.add_entity(rock)
+        chunks.place(Rock, (x, 100))
         x += 16
 
-    rock = Rock(world, (x-16, 100-16))
-    world.add_entity(rock)
+    chunks.place(Rock, (x-16, 100-16))
 
-    goomba = Goomba(world, (x-16, 100-16+1-20))
-#    goomba = Goomba(world, (x-16, 200))
-    world.add_entity(goomba)
+    chunks.place(Goomba, (x-16, 100-16+1-20))
+#    chunks.place(Goomba, (x-16, 200))
 
 #####left side rock#####
     x = 0
     rock_cnt = 6
     for i in xrange(rock_cnt):
-        rock = Rock(world, (x, 120))
-        world.add_entity(rock)
+        chunks.place(Rock, (x, 120))
         x += 16
 
 #####left side brick#####
     x = 32
     brick_cnt = 3
     for i in xrange(brick_cnt):
-        brick = Brick(world, (x, 64))
-        world.add_entity(brick)
+        chunks.place(Brick, (x, 64))
         x += 16
 
     ##Below add row across top of the screen##
     x = 0
-    rock_cnt = ORIGINAL_SIZE[0]/16
+    rock_cnt = world.width/16
     for i in xrange(rock_cnt):
-        rock = Rock(world, (x, 16))
-        world.add_entity(rock)
+        chunks.place(Rock, (x, 16))
         x += 16
 
+    #one koopa at a time
+    world.spawner.add_point(SpawnPoint(Koopa, EntityName.KOOPA, (144, 160),
+                                       ENEMY_SPAWN_FRAMES, 1))
     return world
 
 def get_img(path):
     return pygame.image.load(path).convert_alpha()
 
-def build_rect_from_pos(pos, w, h):
-    w -= 1
-    h -= 1
-    left = pos[0]
-    top = pos[1] - h
-    return pygame.Rect((left, top), (w, h))
-
-counter = 0
-def generate_enemy(world):
-    goomba_max_cnt = 1
-    goomba_cnt = 0
-
-    global counter
-    counter += 1
-    counter %= 60
-    if counter != 0:
+def get_entity_eid(entity):
+    return entity.eid
+
+def make_int_column(size):
+    if numpy is not None:
+        return numpy.zeros(size, numpy.int32)
+    return array.array("i", [0]) * size
+
+def grow_int_column(column, size):
+    if numpy is not None:
+        new_column = numpy.zeros(size, numpy.int32)
+        new_column[:len(column)] = column
+        return new_column
+    column.extend([0] * (size - len(column)))
+    return column
+
+def blit_all(surface, blits):
+    #Surface.blits is only in pygame 1.9.4 and later
+    if hasattr(surface, "blits"):
+        surface.blits(blits, 0)
         return
-
-    for entity in world.entities.itervalues():
-        if entity.name == EntityName.KOOPA:
-            goomba_cnt += 1
-
-    if goomba_cnt < goomba_max_cnt: 
-        #goomba = Goomba(world, (230, 60))
-        goomba = Koopa(world, (144, 160))
-        world.add_entity(goomba)
+    for img, dest in blits:
+        surface.blit(img, dest)
+
+def merge_rects(rects):
+    #union overlapping rects until none of the results overlap
+    merged = []
+    for rect in rects:
+        i = rect.collidelist(merged)
+        while i != -1:
+            rect = rect.union(merged.pop(i))
+            i = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+def build_rect_from_hitbox(pos, hitbox):
+    offset_x, w, h = hitbox
+    return pygame.Rect((pos[0]+offset_x, pos[1]-h), (w, h))
 
 SCREEN_BK_COLOR = (148, 148, 255, 255)
 
 ORIGINAL_SIZE = (256, 240)
 ENARGE_SCALE = 3
 FRAME_RATE = 60
-SCREEN_SIZE = (ORIGINAL_SIZE[0]*ENARGE_SCALE, ORIGINAL_SIZE[1]*ENARGE_SCALE)
+#wider than ORIGINAL_SIZE scrolls, the camera follows mario
+LEVEL_WIDTH = ORIGINAL_SIZE[0]
 
 GROUND_BLOCK_ROWS = 2
 GROUND_BLOCK_H = 16
@@ -2567,11 +4150,181 @@ GROUND_Y = ORIGINAL_SIZE[1] - GROUND_BLOCK_ROWS*GROUND_BLOCK_H
 
 MARIO_START_X = 16
 
+GRID_CELL_SIZE = 32
+#level streaming, see ChunkStreamer; unloading further out than loading
+#keeps a chunk at the view edge from being created again every frame
+CHUNK_WIDTH = 256
+CHUNK_LOAD_MARGIN = 64
+CHUNK_UNLOAD_MARGIN = 256
+#entities this far out of the camera view are still drawn, covers sprites
+#drawn off their hitbox
+CULL_MARGIN = 16
+TILE_SIZE = 16
+#broad phase margin of the per-frame contact table, larger than what any
+#entity moves within one frame
+CONTACT_MARGIN = 16
+#mirror rect extents, heading and speed of enemies and mario in
+#ComponentStore arrays so walking enemies move in one batched pass, at the
+#cost of a column sync on every move
+USE_COMPONENTS = True
+#redraw, scale and present only the areas that changed each frame,
+#instead of the full frame with display.flip
+USE_DIRTY_RECTS = True
+#one of Upscaler.MODES, how the frame is stretched to the window
+UPSCALE_MODE = "nearest"
+#per frame steps timed by run_headless, in run() order
+HEADLESS_PHASES = ("events", "update", "render", "scale", "present")
+#record frame phase and entity update spans in run(), see Tracer; the
+#last TRACE_CAPACITY are written to TRACE_PATH on TRACE_KEY and on exit
+USE_TRACER = False
+TRACE_CAPACITY = 65536
+TRACE_PATH = "mario_trace.json"
+TRACE_KEY = K_F12
+#frames run by --headless without -n, see main()
+HEADLESS_FRAMES = 3000
+#lines of the --profile text summary
+PROFILE_LINES = 60
+#ms between stack samples of --sample
+SAMPLE_INTERVAL_MS = 5
+#draw IS_STATIC entities from one cached layer instead of every frame
+USE_STATIC_LAYER = True
+#the static layer covers this much of the level past each side of the view,
+#and is only rebuilt once the camera scrolls out of it
+STATIC_LAYER_MARGIN = CHUNK_WIDTH
+
+#(frames, offset_y) steps of a falling enemy
+ENEMY_FALL_DATA = [(2, 1), (8, 3), (0, 5)]
+
+#free entities kept per pooled class
+POOL_MAX_SIZE = 32
+
+#World.timers near wheel size, timers further out wait in the far wheel
+TIMER_WHEEL_SLOTS = 256
+#frames between koopa spawn checks on the stock level
+ENEMY_SPAWN_FRAMES = 60
+
+#written by build_atlas.py, next to the sheet it describes
+ATLAS_MANIFEST = "sprites_atlas.json"
+
 game_rc = None
 sys_font = None
 time_passed = 0
+#Tracer recording frame phases and entity updates, None when off
+tracer = None
+
+def init_headless(render=False):
+    #SDL dummy video driver, nothing is shown; returns the Upscaler to
+    #render through, or None
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    pygame.init()
+    upscaler = None
+    if render:
+        upscaler = Upscaler(UPSCALE_MODE, ENARGE_SCALE)
+    else:
+        pygame.display.set_mode(ORIGINAL_SIZE, 0, 32)
 
-def run():
+    global game_rc
+    game_rc = GameRc()
+    return upscaler
+
+def load_key_script(path):
+    #json list of [frame, "down" or "up", key], key as in the pygame K_
+    #constants, "RIGHT" or "f"; gives frame -> key events for run_headless
+    with open(path) as f:
+        steps = json.load(f)
+    script = {}
+    for frame, action, key_name in steps:
+        if action == "down":
+            event_type = KEYDOWN
+        elif action == "up":
+            event_type = KEYUP
+        else:
+            raise ValueError("unknown key action %s" % action)
+        key = getattr(pygame.locals, "K_" + key_name, None)
+        if key is None:
+            raise ValueError("unknown key %s" % key_name)
+        event = pygame.event.Event(event_type, key=key)
+        script.setdefault(frame, []).append(event)
+    return script
+
+def get_peak_memory():
+    #peak resident set size in KB, None where resource is missing
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak /= 1024
+    return peak
+
+def run_headless(world, frames, script=None, upscaler=None):
+    #the run() loop as fast as it goes, no clock; renders and presents
+    #only with an upscaler. returns ticks per second, the ms each phase
+    #takes per frame and the peak memory
+    timer = timeit.default_timer
+    if tracer is not None:
+        timer = tracer.clock
+    phase_time = dict((name, 0.0) for name in HEADLESS_PHASES)
+    start = timer()
+    for frame in xrange(frames):
+        time0 = timer()
+        pygame.event.pump()
+        if script is not None:
+            for event in script.get(frame, ()):
+                world.process_key(event)
+        time1 = timer()
+        world.update()
+        time2 = timer()
+        phase_time["events"] += time1 - time0
+        phase_time["update"] += time2 - time1
+        if tracer is not None:
+            tracer.add("events", "frame", time0, time1)
+            tracer.add("update", "frame", time1, time2)
+        if upscaler is None:
+            continue
+
+        if USE_DIRTY_RECTS:
+            rects = world.render_dirty(upscaler.frame)
+        else:
+            world.render(upscaler.frame)
+            rects = None
+        time3 = timer()
+        update_rects = upscaler.upscale(rects)
+        time4 = timer()
+        upscaler.flip(update_rects)
+        time5 = timer()
+        phase_time["render"] += time3 - time2
+        phase_time["scale"] += time4 - time3
+        phase_time["present"] += time5 - time4
+        if tracer is not None:
+            tracer.add("render", "frame", time2, time3)
+            tracer.add("scale", "frame", time3, time4)
+            tracer.add("present", "frame", time4, time5)
+    elapsed = timer() - start
+
+    phase_ms = {}
+    for name, seconds in phase_time.iteritems():
+        phase_ms[name] = seconds * 1000 / max(frames, 1)
+    return {"frames": frames,
+            "seconds": elapsed,
+            "ticks_per_sec": frames / elapsed if elapsed > 0 else 0.0,
+            "phase_ms": phase_ms,
+            "entities": len(world.entity_list),
+            "spawned": world.spawner.spawn_count,
+            "peak_memory_kb": get_peak_memory()}
+
+def report_headless(result):
+    print "%d frames in %.3f s, %.1f ticks/s, %d entities at the end, " \
+          "%d spawned" % (result["frames"], result["seconds"],
+                          result["ticks_per_sec"], result["entities"],
+                          result["spawned"])
+    for name in HEADLESS_PHASES:
+        print "%-8s %8.3f ms/frame" % (name, result["phase_ms"][name])
+    if result["peak_memory_kb"] is not None:
+        print "peak memory %d KB" % result["peak_memory_kb"]
+
+def run(max_frames=None, width=None):
+    #the game in a window until quit, or for max_frames frames
     logging.basicConfig(level=logging.DEBUG, filename="dbg.log",\
                         format="%(asctime)s %(levelname)s - %(message)s")
 
@@ -2581,8 +4334,8 @@ def run():
     pygame.init()
     #flags = pygame.DOUBLEBUF | pygame.HWSURFACE | pygame.FULLSCREEN
     flags = 0
-    screen = pygame.display.set_mode(SCREEN_SIZE, flags, 24)
-    sscreen = pygame.Surface(ORIGINAL_SIZE, 0, 32)
+    upscaler = Upscaler(UPSCALE_MODE, ENARGE_SCALE, flags)
+    sscreen = upscaler.frame
 
     global sys_font
     #sys_font = pygame.font.SysFont("Arial", 24)
@@ -2590,45 +4343,151 @@ def run():
     global game_rc
     game_rc = GameRc()
 
-    mario = None
-    world = construct_world()
+    global tracer
+    if USE_TRACER:
+        tracer = Tracer(TRACE_CAPACITY)
 
-    world.render(sscreen)
-    pygame.transform.smoothscale(sscreen.convert(), SCREEN_SIZE, screen)
+    mario = None
+    if width is None:
+        width = LEVEL_WIDTH
+    world = construct_world(width)
 
-    pygame.display.flip()
+    if USE_DIRTY_RECTS:
+        upscaler.present(world.render_dirty(sscreen))
+    else:
+        world.render(sscreen)
+        upscaler.present()
 
     clock = pygame.time.Clock()
 
     do_save_screen = False
     save_screen_idx = 0
 
-    while True:
+    frame = 0
+    while max_frames is None or frame < max_frames:
+        frame += 1
         for event in pygame.event.get():
             if event.type == QUIT:
-                pygame.quit()
-                sys.exit()
+                quit_game()
             if event.type == KEYDOWN and event.key == K_ESCAPE:
-                pygame.quit()
-                sys.exit()
+                quit_game()
+            if event.type == KEYDOWN and event.key == TRACE_KEY and \
+               tracer is not None:
+                tracer.dump(TRACE_PATH)
             if event.type == KEYDOWN or event.type == KEYUP:
                 world.process_key(event)
+            if event.type == VIDEOEXPOSE:
+                world.invalidate()
+        if tracer is not None:
+            tracer.lap("events")
 
         #scalex1, tick 60, scalex2, tick 40
         time_passed = clock.tick(FRAME_RATE)
+        if tracer is not None:
+            tracer.lap("tick")
         world.update()
+        if tracer is not None:
+            tracer.lap("update")
 
-        generate_enemy(world)
-
-        world.render(sscreen)
-        pygame.transform.smoothscale(sscreen.convert(), SCREEN_SIZE, screen)
+        if USE_DIRTY_RECTS:
+            rects = world.render_dirty(sscreen)
+        else:
+            world.render(sscreen)
+            rects = None
+        if tracer is not None:
+            tracer.lap("render")
 
         #print "fps:", clock.get_fps()
 
-        #pygame.display.update()
-        pygame.display.flip()
+        update_rects = upscaler.upscale(rects)
+        if tracer is not None:
+            tracer.lap("scale")
+        upscaler.flip(update_rects)
+        if tracer is not None:
+            tracer.lap("present")
+
+    if tracer is not None:
+        tracer.dump(TRACE_PATH)
+    pygame.quit()
+
+def quit_game():
+    if tracer is not None:
+        tracer.dump(TRACE_PATH)
+    pygame.quit()
+    sys.exit()
+
+def run_headless_main(args):
+    upscaler = init_headless(args.render)
+    script = None
+    if args.script is not None:
+        script = load_key_script(args.script)
+    world = construct_world(args.width)
+    frames = args.frames
+    if frames is None:
+        frames = HEADLESS_FRAMES
+    report_headless(run_headless(world, frames, script, upscaler))
+
+def write_profile(profiler, path, sort):
+    #pstats for snakeviz or pstats.Stats, and a text summary next to it
+    profiler.dump_stats(path)
+    with open(path + ".txt", "w") as f:
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats(sort).print_stats(PROFILE_LINES)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Super Mario")
+    parser.add_argument("--headless", action="store_true",
+                        help="run_headless on the SDL dummy video driver "
+                        "instead of the game window")
+    parser.add_argument("--render", action="store_true",
+                        help="with --headless, render and present too")
+    parser.add_argument("-n", "--frames", type=int,
+                        help="stop after this many frames, %d by default "
+                        "with --headless" % HEADLESS_FRAMES)
+    parser.add_argument("--width", type=int, default=LEVEL_WIDTH,
+                        help="level width in pixels")
+    parser.add_argument("--script",
+                        help="with --headless, json key script to replay, "
+                        "see load_key_script")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="run under cProfile, write pstats to PATH "
+                        "and a summary to PATH.txt")
+    parser.add_argument("--sort", default="cumulative",
+                        help="order of the --profile summary")
+    parser.add_argument("--sample", metavar="PATH",
+                        help="sample the stack every --interval ms, write "
+                        "collapsed stacks for flame graphs to PATH")
+    parser.add_argument("--interval", type=float,
+                        default=SAMPLE_INTERVAL_MS,
+                        help="ms between --sample samples")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.headless:
+        func = lambda: run_headless_main(args)
+    else:
+        func = lambda: run(args.frames, args.width)
+
+    sampler = None
+    if args.sample is not None:
+        sampler = StackSampler(args.interval / 1000.0)
+        sampler.start()
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+    #quitting the game exits through here too, the output is still written
+    try:
+        if profiler is not None:
+            profiler.runcall(func)
+        else:
+            func()
+    finally:
+        if sampler is not None:
+            sampler.stop()
+            sampler.write(args.sample)
+        if profiler is not None:
+            write_profile(profiler, args.profile, args.sort)
 
 if __name__ == "__main__":
-    run()
-    #import profile
-    #profile.run("run()")
+    main()
@@ -285,6 +285,8 @@ class Palette(object):
             self.selector_idx = idx
 
 class ViewChange(object):
+    __slots__ = ("pos", "old_color", "new_color")
+
     def __init__(self, pos, old_color, new_color):
         self.pos = tuple(pos) #copy out the pos
         self.old_color = old_color